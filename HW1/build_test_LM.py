@@ -5,22 +5,212 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import math
 import re
 import nltk
 import sys
 import getopt
+import collections
+import itertools
+import mmap
+import multiprocessing
+import struct
+
+import numpy as np
+
+
+NGRAM_SIZE = 4
+OTHER_LANGUAGE_THRESHOLD = 0.75  # a line is in an 'other' language if more of its n-grams than this were never seen
+TEST_BATCH_SIZE = 10000  # number of test lines that are classified at once
+EARLY_EXIT_CHUNK_SIZE = 100  # number of n-grams of every line that are scored at once when classifying with a margin
+MAX_PREFIX_TABLE_SIZE = 2 ** 22  # the largest (n-1)-gram prefix table, for larger alphabets the n-grams are searched
+MODEL_MAGIC = b'HW1LMOD1'  # the first bytes of a model file, see write_LM
+MODEL_HEADER = struct.Struct('<8s6Q')
+SKETCH_DEPTH = 2  # number of hash functions (rows) of a count-min sketch model, 1 is a hashed feature space
+SKETCH_SEED = 4  # the seed of the hash functions of a count-min sketch model
+SKETCH_MAGIC = b'HW1CMS01'  # the first bytes of a count-min sketch model file
+SKETCH_HEADER = struct.Struct('<8s5Q')
+SKETCH_MAX_COUNT = 2 ** 32 - 1  # the counts of a count-min sketch are uint32, and stop at this count
+UNICODE_SIZE = 0x110000  # number of code points, the base of the (hashed) n-gram keys of a count-min sketch model
+
+
+class LanguageModel:
+    """
+    An n-gram language model of every language in the training data.
+
+    The characters are converted to digits, the index of the character in alphabet (the sorted code points of all
+    characters in the training data), and every n-gram is interned to an integer key (see create_ngrams). The id of an
+    n-gram is the index of its key in the sorted array grams, and row i of the (number of n-grams + 1 x number of
+    languages) matrix gram_log_probabilities holds the add-1 smoothed log-probability of n-gram i in every language.
+    The last row is the id of all n-grams that are not in the model, its log-probabilities are 0 so that it does not
+    change the probability of a line.
+
+    The n-gram ids are looked up in two steps: the key of the first n-1 characters (the prefix) of an n-gram is the
+    index of a row in gram_table (prefix_rows), or of the last row if no n-gram of the model starts with the prefix,
+    and the last character is the column of the id of the n-gram in that row. For alphabets that are too large for
+    these tables (prefix_rows is None), the n-grams are binary searched in grams instead.
+    """
+    def __init__(self, languages, alphabet, grams, gram_log_probabilities, prefix_rows, gram_table):
+        self.languages = languages
+        self.alphabet = alphabet
+        self.grams = grams
+        self.gram_log_probabilities = gram_log_probabilities
+        self.prefix_rows = prefix_rows
+        self.gram_table = gram_table
+        self.base = len(alphabet) + 1  # the digit len(alphabet) is used for the characters that are not in alphabet
+
+        # code point -> digit, the code points after the last character of the alphabet share the last entry
+        self.character_digits = np.full(int(alphabet.max(initial=0)) + 2, len(alphabet), dtype=np.int64)
+        self.character_digits[alphabet] = np.arange(len(alphabet))
+
+    def digits(self, characters):
+        """
+        Converts an array of code points to their digits.
+        """
+        return self.character_digits[np.minimum(characters, len(self.character_digits) - 1)]
+
+    def gram_ids(self, grams):
+        """
+        Converts an array of n-gram keys to their ids, where the n-grams that are not in the model get id len(grams).
+        """
+        if self.prefix_rows is not None:
+            return self.gram_table[self.prefix_rows[grams // self.base], grams % self.base]
+
+        ids = np.minimum(np.searchsorted(self.grams, grams), len(self.grams) - 1)
+        return np.where(self.grams[ids] == grams, ids, len(self.grams))
+
+    def ngrams(self, characters, lengths):
+        """
+        Returns the n-grams of the lines with the given code points and lengths, see create_ngrams.
+        """
+        return create_ngrams(self.digits(characters), lengths, self.base)
+
+    def log_probabilities(self, grams):
+        """
+        Returns the log-probabilities of the n-grams in every language (number of n-grams x number of languages) and
+        whether every n-gram is not in the model (its log-probabilities are 0).
+        """
+        gram_ids = self.gram_ids(grams)
+        return np.take(self.gram_log_probabilities, gram_ids, axis=0), gram_ids == len(self.grams)
+
+
+class SketchLanguageModel:
+    """
+    An n-gram language model that counts the n-grams in a count-min sketch of a fixed size, so that the memory of the
+    model does not grow with the number of distinct n-grams in the training data.
+
+    Every n-gram is hashed to an integer key (the number with the n code points of its characters in base
+    UNICODE_SIZE, modulo 2^64), and every row r of counts (depth x width x number of languages) counts the n-grams in
+    the buckets sketch_buckets(key, multipliers[r], width). The count of an n-gram in a language is the smallest count
+    of its buckets, which is its true count plus the counts of the n-grams that collide with it in every row. The
+    n-grams whose count is 0 in every language are not in the model.
+
+    The add-1 smoothing needs the number of distinct n-grams, which the sketch does not keep. It is estimated from the
+    number of empty buckets of the first row (linear counting).
+    """
+    base = UNICODE_SIZE
+
+    def __init__(self, languages, multipliers, language_totals, counts, vocabulary_size):
+        self.languages = languages
+        self.multipliers = multipliers
+        self.language_totals = language_totals
+        self.counts = counts
+        self.vocabulary_size = vocabulary_size
+
+    def ngrams(self, characters, lengths):
+        return create_ngrams(characters.astype(np.uint64), lengths, self.base, wrap=True)
+
+    def log_probabilities(self, grams):
+        width = self.counts.shape[1]
+        gram_counts = np.take(self.counts[0], sketch_buckets(grams, self.multipliers[0], width), axis=0)
+        for row in range(1, len(self.counts)):
+            row_counts = np.take(self.counts[row], sketch_buckets(grams, self.multipliers[row], width), axis=0)
+            np.minimum(gram_counts, row_counts, out=gram_counts)
+
+        is_unknown = ~gram_counts.any(axis=1)
+        # the counts are uint32, a saturated count (SKETCH_MAX_COUNT) + 1 would wrap around to 0
+        log_probabilities = np.log((gram_counts.astype(np.float64) + 1) / (self.language_totals + self.vocabulary_size))
+        log_probabilities[is_unknown] = 0
+
+        return log_probabilities, is_unknown
+
+
+def sketch_buckets(grams, multiplier, width):
+    """
+    Returns the bucket of every (uint64) n-gram key in the count-min sketch row with the given multiplier.
+
+    The bucket is taken from the highest 32 bits of key * multiplier (mod 2^64), which depend on every bit of the key,
+    scaled to [0, width) by (bits * width) >> 32.
+    """
+    return (((grams * multiplier) >> np.uint64(32)) * np.uint64(width)) >> np.uint64(32)
+
+
+def create_lookup_tables(grams, base, n=NGRAM_SIZE):
+    """
+    Returns the prefix_rows and gram_table of the sorted n-gram keys (see LanguageModel), or None, None if the
+    alphabet is too large.
+    """
+    if base ** (n - 1) > MAX_PREFIX_TABLE_SIZE:
+        return None, None
+
+    prefixes, gram_rows = np.unique(grams // base, return_inverse=True)
+
+    prefix_rows = np.full(base ** (n - 1), len(prefixes), dtype=np.int32)
+    prefix_rows[prefixes] = np.arange(len(prefixes))
+
+    gram_table = np.full((len(prefixes) + 1, base), len(grams), dtype=np.int32)
+    gram_table[gram_rows.ravel(), grams % base] = np.arange(len(grams))
+
+    return prefix_rows, gram_table
+
+
+def code_points(lines):
+    """
+    Returns the code points of the characters of all lines (NumPy array) and the length of every line.
+    """
+    lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    return np.frombuffer(''.join(lines).encode('utf-32-le'), dtype='<u4'), lengths
 
 
-def create_ngram(sentence, n):
+def create_ngrams(digits, lengths, base, n=NGRAM_SIZE, wrap=False):
     """
-    takes a string (sentence) and an integer n.
-    constructs and returns an array of the string's n-grams.
+    takes the digits of the characters of a list of lines, the lengths of the lines, the base of the digits and an
+    integer n.
+    constructs and returns an array of the n-grams of all lines (in order) and an array of the number of n-grams of
+    every line.
 
-    Use a window sliding technique to iteratively take the characters between index i and i+4 for all i s.t.
-    we start with left side of window at i = 0, and end when right side of window at i = <idx of last character>
+    Every n-gram is represented by an integer key, the number with the n digits of its characters in the given base.
+    The n-grams of all lines are taken at once with a sliding window over the concatenated lines, where the windows
+    that span two lines are left out. E.g. ['hello', 'hi'] -> ['hell', 'ello'] (as keys), [2, 0]
+
+    If wrap, the digits are uint64 and the keys are computed modulo 2^64, which hashes the n-grams of any base.
+    """
+    counts = np.maximum(lengths - n + 1, 0)
+    if base ** n >= 2 ** 63 and not wrap:
+        raise ValueError(f'The alphabet of {base - 1} characters is too large for {n}-grams')
+
+    dtype = np.uint64 if wrap else np.int64
+    if len(digits) < n:
+        return np.array([], dtype=dtype), counts
+
+    number_of_windows = len(digits) - n + 1
+    grams = np.zeros(number_of_windows, dtype=dtype)
+    for i in range(n):
+        grams *= dtype(base)
+        grams += digits[i:i + number_of_windows]
+
+    # a window is in a line if it ends before (or at) the end of the line where it starts
+    line_ends = np.repeat(np.cumsum(lengths), lengths)[:number_of_windows]
+    in_line = np.arange(number_of_windows) + n <= line_ends
+
+    return grams[in_line], counts
+
+
+def split_training_line(line):
+    """
+    Separates the language and the rest of the string (in lowercase, for more matches when testing) of a training line.
     """
-    return [sentence[i:i + n] for i in range(len(sentence) - n + 1)]
+    split_line = line.split()
+    return split_line[0], ' '.join(split_line[1:]).lower()
 
 
 def build_LM(in_file):
@@ -28,145 +218,401 @@ def build_LM(in_file):
     build language models for each label
     each line in in_file contains a label and a string separated by a space
     """
-    print("building language models...")
+    print("building language models...", file=sys.stderr)
 
-    language_string_to_language_idx = {'malaysian': 0, 'indonesian': 1, 'tamil': 2}
-
-    training_data = []
+    line_languages = []
+    sentences = []
 
     with open(in_file, 'r') as input_text:
         for line in input_text:
-            split_line = line.split()
-            language, text = split_line[0], ' '.join(split_line[1:])  # Separate language and the rest of the
-            # string into two variables
-            training_data.append([language, text])
+            language, sentence = split_training_line(line)
+            line_languages.append(language)
+            sentences.append(sentence)
+
+    languages = sorted(set(line_languages))  # the languages come from the training data
+    language_to_language_idx = {language: idx for idx, language in enumerate(languages)}
+
+    characters, lengths = code_points(sentences)
+    alphabet, digits = np.unique(characters, return_inverse=True)
+
+    all_grams, counts = create_ngrams(digits.ravel().astype(np.int64), lengths, len(alphabet) + 1)
+    # Converts something like 'hello hi' into ['hell', 'ello', 'llo ', 'lo h', 'o hi'] (as keys)
+
+    grams, gram_ids = np.unique(all_grams, return_inverse=True)  # the sorted n-grams and the id of every n-gram
+    gram_languages = np.repeat([language_to_language_idx[language] for language in line_languages], counts)
 
-    LM = [{}, {}, {}]  # Array that contains three dictionaries, one for each language.
+    # count every n-gram in every language
+    gram_counts = np.bincount(gram_ids.ravel() * len(languages) + gram_languages,
+                              minlength=len(grams) * len(languages)).reshape(len(grams), len(languages))
 
-    for lang_dict in LM:
-        lang_dict['counter'] = 0  # Introduce a counter for how many ngrams have been used for this specific language.
+    # Add-1 smoothing, every n-gram is counted once more in every language, so the number of n-grams of a language
+    # goes up by the number of distinct n-grams. Log-probabilities to overcome underflow problems.
+    log_probabilities = np.log((gram_counts + 1) / (gram_counts.sum(axis=0) + len(grams)))
+    gram_log_probabilities = np.vstack([log_probabilities, np.zeros((1, len(languages)))])
 
-    for training_row in training_data:
-        current_language = language_string_to_language_idx[training_row[0]]
-        # Use dictionary to convert language in string representation to a index.
+    prefix_rows, gram_table = create_lookup_tables(grams, len(alphabet) + 1)
 
-        sentence = training_row[1].lower()  # Converts all uppercase characters to lowercase.
+    return LanguageModel(languages, alphabet.astype(np.uint32), grams, gram_log_probabilities, prefix_rows, gram_table)
 
-        four_gram = create_ngram(sentence, 4)
-        # Converts something like 'hello hi' into ['hell', 'ello', 'llo ', 'lo h', 'o hi']
 
-        for gram in four_gram:
-            if gram not in LM[0]:  # Check if this gram is NOT in the malaysian dictionary.
-                # If the gram have been seen before, it must be in all languages dictionaries (incl. Malaysian)
-                for lang_dict in LM:  # If first time we see this gram, we create a new key-value pair
-                    # with key = gram and value = 0 in all the three different language dictionaries.
-                    lang_dict[gram] = 0
+def build_sketch_LM(in_file, width, depth=SKETCH_DEPTH):
+    """
+    build language models for each label, counting the n-grams in a count-min sketch of the given width and depth
+    (see SketchLanguageModel). The training lines are read lazily, in batches, so the memory is that of the sketch
+    (depth * width * number of languages uint32 counts) however large in_file is.
+    """
+    print("building language models...", file=sys.stderr)
+
+    multipliers = np.random.RandomState(SKETCH_SEED).randint(0, 2 ** 63, size=depth, dtype=np.int64)
+    multipliers = multipliers.astype(np.uint64) * np.uint64(2) + np.uint64(1)  # odd 64-bit multipliers
+
+    language_to_language_idx = {}
+    language_counts = []  # the flattened depth x width counts of every language
+    language_totals = []
+
+    with open(in_file, 'r') as input_text:
+        for batch in read_batches(input_text):
+            line_languages, sentences = zip(*map(split_training_line, batch))
+            for language in line_languages:
+                if language not in language_to_language_idx:
+                    language_to_language_idx[language] = len(language_counts)
+                    language_counts.append(np.zeros(depth * width, dtype=np.uint32))
+                    language_totals.append(0)
+
+            characters, lengths = code_points(sentences)
+            grams, counts = create_ngrams(characters.astype(np.uint64), lengths, UNICODE_SIZE, wrap=True)
+            gram_languages = np.repeat([language_to_language_idx[language] for language in line_languages], counts)
 
-            LM[current_language][gram] += 1  # Add one to the counter of this specific gram for the current language.
-            LM[current_language]['counter'] += 1  # The current language have been trained on one more gram,
-            # so the counter should be incremented.
+            for language_idx in np.unique(gram_languages).tolist():
+                language_grams = grams[gram_languages == language_idx]
+                language_totals[language_idx] += len(language_grams)
 
-    for lang_dict in LM:
-        for key in lang_dict.keys():
-            if key != 'counter':
-                lang_dict[key] += 1  # Add-1 smoothing
-                lang_dict['counter'] += 1  # Must also add 1 to the counter for the probabilities to remain
-                # stochastic rows.
+                buckets = np.concatenate([row * width + sketch_buckets(language_grams, multiplier, width)
+                                          for row, multiplier in enumerate(multipliers)])
+                buckets, bucket_counts = np.unique(buckets, return_counts=True)
 
-        for key in lang_dict.keys():
-            if key != 'counter':
-                # Create probabilities instead of just counting number of appearances.
-                lang_dict[key] = math.log(lang_dict[key] / lang_dict['counter'])
-                # Log-probabilities to overcome underflow problems.
+                sketch = language_counts[language_idx]
+                sketch[buckets] = np.minimum(sketch[buckets] + bucket_counts, SKETCH_MAX_COUNT)
 
-    return LM
+    languages = sorted(language_to_language_idx)  # the languages come from the training data
+    language_order = [language_to_language_idx[language] for language in languages]
+    counts = np.stack([language_counts[language_idx].reshape(depth, width) for language_idx in language_order], axis=-1)
+    del language_counts
 
+    # linear counting: with v distinct n-grams, a bucket is empty with probability (1 - 1/width)^v ~ e^(-v/width)
+    empty_buckets = max(int(np.count_nonzero(~counts[0].any(axis=1))), 1)
+    vocabulary_size = int(round(-width * np.log(empty_buckets / width)))
 
-def test_LM(in_file, out_file, LM):
+    return SketchLanguageModel(languages, multipliers, np.array([language_totals[idx] for idx in language_order]),
+                               counts, vocabulary_size)
+
+
+def write_LM(LM, model_file):
     """
-    test the language models on new strings
-    each line of in_file contains a string
-    you should print the most probable label for each string into out_file
+    Writes the language model to a binary file, which load_LM memory-maps. The file is made of
+        header                  ->  MODEL_HEADER (magic, n, size of languages in bytes, number of characters in
+                                    the alphabet, number of n-grams, number of prefixes, has lookup tables)
+        languages               ->  the names of the languages, utf-8 and separated by newlines
+        alphabet                ->  uint32 code point of every character
+        grams                   ->  int64 key of every n-gram, sorted
+        gram_log_probabilities  ->  float64 (number of n-grams + 1 x number of languages), row by row
+        prefix_rows, gram_table ->  int32, only if the model has lookup tables
+    where every section starts at a multiple of 8 bytes. A count-min sketch model is made of
+        header                  ->  SKETCH_HEADER (magic, n, size of languages in bytes, depth, width, estimated
+                                    number of distinct n-grams)
+        languages               ->  the names of the languages, utf-8 and separated by newlines
+        multipliers             ->  uint64 multiplier of the hash function of every row
+        language_totals         ->  int64 number of n-grams of every language
+        counts                  ->  uint32 (depth x width x number of languages)
     """
-    print("testing language models...")
+    languages = '\n'.join(LM.languages).encode('utf-8')
 
-    language_idx_to_language_string = {0: 'malaysian', 1: 'indonesian', 2: 'tamil'}
+    if isinstance(LM, SketchLanguageModel):
+        depth, width, _ = LM.counts.shape
+        header = SKETCH_HEADER.pack(SKETCH_MAGIC, NGRAM_SIZE, len(languages), depth, width, LM.vocabulary_size)
+        sections = [languages, LM.multipliers, LM.language_totals, LM.counts]
+    else:
+        has_lookup_tables = LM.prefix_rows is not None
+        number_of_prefixes = len(LM.gram_table) - 1 if has_lookup_tables else 0
 
-    out_text = ''  # This is the string that will be iteratively appended and finally written to the outfile.
+        header = MODEL_HEADER.pack(MODEL_MAGIC, NGRAM_SIZE, len(languages), len(LM.alphabet), len(LM.grams),
+                                   number_of_prefixes, has_lookup_tables)
+        sections = [languages, LM.alphabet, LM.grams, LM.gram_log_probabilities]
+        if has_lookup_tables:
+            sections += [LM.prefix_rows, LM.gram_table]
 
-    test_data = []
+    with open(model_file, 'wb') as write_model:
+        write_model.write(header)
 
-    with open(in_file, 'r') as input_text:
-        for line in input_text:
-            test_data.append(line)
+        for section in sections:
+            section_bytes = section if isinstance(section, bytes) else np.ascontiguousarray(section).tobytes()
+            write_model.write(section_bytes + bytes(-len(section_bytes) % 8))
+
+
+def load_LM(model_file):
+    """
+    Memory-maps a language model (or count-min sketch model) written by write_LM. The arrays of the model are read
+    directly from the file, so the model can be used right away, and processes that load the same model file share one
+    copy of it in memory.
+    """
+    with open(model_file, 'rb') as read_model:
+        model = mmap.mmap(read_model.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, n = struct.unpack_from('<8sQ', model)
+    if magic not in (MODEL_MAGIC, SKETCH_MAGIC):
+        raise ValueError(f'{model_file} is not a language model')
+    if n != NGRAM_SIZE:
+        raise ValueError(f'{model_file} is a {n}-gram language model, not a {NGRAM_SIZE}-gram language model')
+
+    offset = MODEL_HEADER.size if magic == MODEL_MAGIC else SKETCH_HEADER.size
+
+    def read_section(dtype, count):
+        nonlocal offset
+        section = np.frombuffer(model, dtype=dtype, count=count, offset=offset)
+        offset += section.nbytes + (-section.nbytes % 8)
+        return section
+
+    if magic == SKETCH_MAGIC:
+        _, _, languages_size, depth, width, vocabulary_size = SKETCH_HEADER.unpack_from(model)
+
+        languages = read_section(np.uint8, languages_size).tobytes().decode('utf-8').split('\n')
+        multipliers = read_section(np.uint64, depth)
+        language_totals = read_section(np.int64, len(languages))
+        counts = read_section(np.uint32, depth * width * len(languages)).reshape(depth, width, len(languages))
+
+        return SketchLanguageModel(languages, multipliers, language_totals, counts, vocabulary_size)
+
+    _, _, languages_size, alphabet_size, number_of_grams, number_of_prefixes, has_lookup_tables = \
+        MODEL_HEADER.unpack_from(model)
+
+    languages = read_section(np.uint8, languages_size).tobytes().decode('utf-8').split('\n')
+    alphabet = read_section(np.uint32, alphabet_size)
+    grams = read_section(np.int64, number_of_grams)
+    gram_log_probabilities = read_section(np.float64, (number_of_grams + 1) * len(languages))
+    gram_log_probabilities = gram_log_probabilities.reshape(number_of_grams + 1, len(languages))
+
+    prefix_rows = gram_table = None
+    if has_lookup_tables:
+        base = alphabet_size + 1
+        prefix_rows = read_section(np.int32, base ** (NGRAM_SIZE - 1))
+        gram_table = read_section(np.int32, (number_of_prefixes + 1) * base).reshape(number_of_prefixes + 1, base)
 
-    for test_line in test_data:
+    # the arrays keep the memory map open
+    return LanguageModel(languages, alphabet, grams, gram_log_probabilities, prefix_rows, gram_table)
 
-        four_gram = create_ngram(test_line, 4)
 
-        probabilities = [1, 1, 1]  # Initial probability is 1 for all languages.
-        # Log(1) = 0, so this is a neutral starting value for the probability.
-        gram_c = 0
-        new_grams = 0
-        for gram in four_gram:
+def most_likely_languages(LM, probabilities, unknown_grams, counts):
+    """
+    Returns the most probable language of every line, given the log-probabilities of the line in every language,
+    the number of n-grams of the line that were never seen and the number of n-grams of the line.
+    """
+    most_likely_language_idx = np.argmax(probabilities, axis=1).tolist()
+    # If more than 75% of the input grams haven't been in the training set, this is most likely because it is an
+    # 'other' language than those in the training set.
+    is_other = ((unknown_grams > OTHER_LANGUAGE_THRESHOLD * counts) | (counts == 0)).tolist()
+
+    return ['other' if is_other[i] else LM.languages[most_likely_language_idx[i]] for i in range(len(is_other))]
+
+
+def classify_lines(lines, LM, margin=None):
+    """
+    Returns the most probable language of every line (str), or 'other' if most of its n-grams were never seen.
+    With a margin, see classify_lines_early_exit.
+    """
+    if margin is not None:
+        return classify_lines_early_exit(lines, LM, margin)
 
-            gram = gram.lower()  # Converts all uppercase characters to lowercase.
+    characters, lengths = code_points([line.lower() for line in lines])
+    grams, counts = LM.ngrams(characters, lengths)
+    log_probabilities, is_unknown = LM.log_probabilities(grams)
 
-            if gram in LM[0]:  # Check if this gram is in the malaysian dictionary.
-                # If the gram have been seen before, it must be in all languages dictionaries (incl. Malaysian)
+    has_grams = counts > 0
+    line_starts = (np.cumsum(counts) - counts)[has_grams]
 
-                for i in range(3):
-                    probabilities[i] = probabilities[i] + LM[i][gram]
-                    # Multiplication in linear space is same as addition in Log space.
-                    # Src: https://web.stanford.edu/~jurafsky/slp3/3.pdf (Eq. 3.13)
-            else:
-                new_grams += 1
-            gram_c += 1
+    probabilities = np.zeros((len(lines), len(LM.languages)))
+    unknown_grams = np.zeros(len(lines))
+    if len(grams):
+        # Multiplication in linear space is same as addition in Log space, the n-grams that are not in the language
+        # models are skipped. Src: https://web.stanford.edu/~jurafsky/slp3/3.pdf (Eq. 3.13)
+        probabilities[has_grams] = np.add.reduceat(log_probabilities, line_starts, axis=0)
+        unknown_grams[has_grams] = np.add.reduceat(is_unknown.astype(np.int64), line_starts)
 
-        max_prob = max(probabilities)
-        most_likely_language_idx = probabilities.index(max_prob)
-        # Find the index of the language we find most likely to match the string we test.
+    return most_likely_languages(LM, probabilities, unknown_grams, counts)
 
-        if new_grams / gram_c > 0.75:  # If more than 75% of the input gram haven't been in the training set.
-            # Most likely, this is because it is an 'other' language than Malaysian / Indonesian / Tamil.
-            most_likely_language_string = 'other'
+
+def classify_lines_early_exit(lines, LM, margin):
+    """
+    Classifies the lines like classify_lines, but scores the n-grams of every line EARLY_EXIT_CHUNK_SIZE at a time and
+    stops scoring a line once the log-probability of its most probable language is more than margin above that of
+    the second most probable language, i.e. once the line is at least e^margin times as likely to be in the one
+    language as in any other (a sequential probability ratio test). The share of n-grams that were never seen, which
+    decides whether the line is in an 'other' language, is that of the n-grams that were scored.
+    """
+    characters, lengths = code_points([line.lower() for line in lines])
+    line_starts = np.cumsum(lengths) - lengths
+    counts = np.maximum(lengths - NGRAM_SIZE + 1, 0)
+
+    probabilities = np.zeros((len(lines), len(LM.languages)))
+    unknown_grams = np.zeros(len(lines), dtype=np.int64)
+    scored_grams = np.zeros(len(lines), dtype=np.int64)
+
+    active = np.flatnonzero(counts > 0)  # the lines that are still scored
+    while len(active):
+        # the characters of the next n-grams of every active line, which start at its n-gram scored_grams
+        chunk_lengths = np.minimum(counts[active] - scored_grams[active], EARLY_EXIT_CHUNK_SIZE) + NGRAM_SIZE - 1
+        chunk_starts = np.cumsum(chunk_lengths) - chunk_lengths
+        chunk_characters = characters[np.repeat(line_starts[active] + scored_grams[active] - chunk_starts,
+                                                 chunk_lengths) + np.arange(chunk_lengths.sum())]
+
+        grams, chunk_counts = LM.ngrams(chunk_characters, chunk_lengths)
+        log_probabilities, is_unknown = LM.log_probabilities(grams)
+
+        gram_starts = np.cumsum(chunk_counts) - chunk_counts
+        probabilities[active] += np.add.reduceat(log_probabilities, gram_starts, axis=0)
+        unknown_grams[active] += np.add.reduceat(is_unknown.astype(np.int64), gram_starts)
+        scored_grams[active] += chunk_counts
+
+        if len(LM.languages) > 1:
+            two_most_probable = np.partition(probabilities[active], -2, axis=1)[:, -2:]
+            lead = two_most_probable[:, 1] - two_most_probable[:, 0]
         else:
-            most_likely_language_string = language_idx_to_language_string[most_likely_language_idx]
-            # Use a dictionary to convert index to language in string form.
+            lead = np.full(len(active), np.inf)
+
+        active = active[(scored_grams[active] < counts[active]) & (lead <= margin)]
 
-        out_text += f'{most_likely_language_string} {test_line}'  # Append the predicted language
-        # and the string we test on to the string that is going to be written to the outfile.
+    return most_likely_languages(LM, probabilities, unknown_grams, scored_grams)
 
-    with open(out_file, 'w') as text_file:
-        text_file.write(out_text)  # Write the out string we have iteratively created to the out file.
+
+def read_batches(lines, batch_size=TEST_BATCH_SIZE):
+    """
+    Yields the lines in lists of batch_size lines, reading them lazily.
+    """
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+worker_LM = None  # the language model of a classifier process, see init_worker
+
+
+def init_worker(model):
+    """
+    Sets the language model of a classifier process, either the model itself or the model file to memory-map.
+    """
+    global worker_LM
+    worker_LM = load_LM(model) if isinstance(model, str) else model
+
+
+def classify_batch(lines, margin=None):
+    return classify_lines(lines, worker_LM, margin)
+
+
+def classify_batches(batches, LM, processes=1, model_file=None, margin=None):
+    """
+    Yields every batch of lines together with its classification, in order. With more than one process, the batches
+    are classified by a pool of processes, where at most 2 batches per process are read ahead, so that the memory
+    stays the same however many lines there are. The processes memory-map the model file if there is one (and share
+    one copy of the model), otherwise they get the model.
+    """
+    if processes <= 1:
+        for batch in batches:
+            yield batch, classify_lines(batch, LM, margin)
+        return
+
+    with multiprocessing.Pool(processes, init_worker, (model_file if model_file is not None else LM,)) as pool:
+        pending = collections.deque()
+
+        for batch in batches:
+            pending.append((batch, pool.apply_async(classify_batch, (batch, margin))))
+
+            if len(pending) >= 2 * processes:
+                batch, languages = pending.popleft()
+                yield batch, languages.get()
+
+        while pending:
+            batch, languages = pending.popleft()
+            yield batch, languages.get()
+
+
+def test_LM(in_file, out_file, LM, processes=1, model_file=None, margin=None):
+    """
+    test the language models on new strings
+    each line of in_file contains a string
+    you should print the most probable label for each string into out_file
+
+    The lines are read and classified in batches of TEST_BATCH_SIZE lines, and the predictions are written as soon as
+    their batch is classified, in the order of the lines. '-' reads stdin or writes stdout.
+    """
+    print("testing language models...", file=sys.stderr)
+
+    input_text = sys.stdin if in_file == '-' else open(in_file, 'r')
+    text_file = sys.stdout if out_file == '-' else open(out_file, 'w')
+
+    try:
+        batches = classify_batches(read_batches(input_text), LM, processes, model_file, margin)
+        for test_lines, languages in batches:
+            # the predicted language and the string we test on
+            text_file.write(''.join(f'{language} {test_line}' for language, test_line in zip(languages, test_lines)))
+    finally:
+        if input_text is not sys.stdin:
+            input_text.close()
+        if text_file is not sys.stdout:
+            text_file.close()
 
 
 def usage():
     print(
         "usage: "
         + sys.argv[0]
-        + " -b input-file-for-building-LM -t input-file-for-testing-LM -o output-file"
+        + " [-b input-file-for-building-LM] [-m model-file] [-t input-file-for-testing-LM -o output-file]"
+        + " [-j number-of-processes] [-w sketch-width [-k sketch-depth]] [-e early-exit-margin]"
     )
 
 
-input_file_b = input_file_t = output_file = None
-try:
-    opts, args = getopt.getopt(sys.argv[1:], "b:t:o:")
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-for o, a in opts:
-    if o == "-b":
-        input_file_b = a
-    elif o == "-t":
-        input_file_t = a
-    elif o == "-o":
-        output_file = a
+if __name__ == '__main__':
+    input_file_b = input_file_t = output_file = model_file = None
+    number_of_processes = 1
+    sketch_width = None
+    sketch_depth = SKETCH_DEPTH
+    early_exit_margin = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "b:t:o:m:j:w:k:e:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-b":
+            input_file_b = a
+        elif o == "-t":
+            input_file_t = a
+        elif o == "-o":
+            output_file = a
+        elif o == "-j":  # the number of classifier processes
+            number_of_processes = int(a)
+        elif o == "-w":  # count the n-grams in a count-min sketch of this width instead of exactly
+            sketch_width = int(a)
+        elif o == "-k":
+            sketch_depth = int(a)
+        elif o == "-e":  # stop scoring a line once its most probable language leads by this log-probability
+            early_exit_margin = float(a)
+        elif o == "-m":  # the model is written to this file when it is built (-b), and loaded from it otherwise
+            model_file = a
+        else:
+            assert False, "unhandled option"
+    if (input_file_t == None) != (output_file == None) or input_file_b == model_file == None \
+            or (input_file_t == None and model_file == None):
+        usage()
+        sys.exit(2)
+
+    if input_file_b != None:
+        LM = build_LM(input_file_b) if sketch_width == None else build_sketch_LM(input_file_b, sketch_width,
+                                                                                   sketch_depth)
+        if model_file != None:
+            write_LM(LM, model_file)
     else:
-        assert False, "unhandled option"
-if input_file_b == None or input_file_t == None or output_file == None:
-    usage()
-    sys.exit(2)
+        LM = load_LM(model_file)
 
-LM = build_LM(input_file_b)
-test_LM(input_file_t, output_file, LM)
+    if input_file_t != None:
+        test_LM(input_file_t, output_file, LM, number_of_processes, model_file, early_exit_margin)
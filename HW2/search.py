@@ -4,6 +4,7 @@ import re
 import nltk
 import sys
 import getopt
+import time
 
 sys.setrecursionlimit(
     100000)  # had to set recursion limit since some linked lists are long and leads to a lot of recursion
@@ -13,6 +14,7 @@ PRECEDENCE_DICT = {"NOT": 3, "AND": 2, "OR": 1}  # the precedence order for not,
 PORTER_STEMMER = nltk.stem.porter.PorterStemmer()
 STOP_WORDS = set(nltk.corpus.stopwords.words('english') + [".", ",", ";", ":"])
 NUMBER_OF_BLOCKS = 10
+EXPLAIN = False  # print the plan tree of every query with its actual costs (--explain)
 
 with open('term_conversion.txt', 'rb') as read_term_converter:
     term_to_term_id = pickle.load(read_term_converter)  # term (str) -> term id (int, 4 bytes)
@@ -30,6 +32,8 @@ class Posting:
 
 
 class PostingList:
+    skips_followed = 0  # the number of skip pointers followed by all merges so far, used by the plan tree (--explain)
+
     def __init__(self):
         self.head = None
         self.length = 1
@@ -107,6 +111,7 @@ class PostingList:
                 return None
             # we only use the skip ptr if it gets us closer to the larger doc_id of b
             if a.skip is not None and b.doc_id - a.skip.doc_id >= 0:
+                PostingList.skips_followed += 1
                 result = self.and_merge(a.skip, b)
             else:
                 result = self.and_merge(a.next, b)
@@ -116,6 +121,7 @@ class PostingList:
                 return None
             # we only use the skip ptr if it gets us closer to the larger doc_id of a
             if b.skip is not None and a.doc_id - b.skip.doc_id >= 0:
+                PostingList.skips_followed += 1
                 result = self.and_merge(a, b.skip)
             else:
                 result = self.and_merge(a, b.next)
@@ -176,6 +182,7 @@ class PostingList:
                 if a.skip is not None and b.doc_id - a.skip.doc_id >= 0:
                     prev_skip = a   # if we use the skip pointer, we remember where we skipped from.
                                     # "With great power comes great responsibility."
+                    PostingList.skips_followed += 1
                     a = a.skip  # traverse forward using the skip pointer
                 else:
                     a = a.next
@@ -213,8 +220,83 @@ class PostingList:
         return " ".join(nodes)
 
 
+class PlanNode:
+    """
+    A node in the plan tree of a query (--explain). It is either a term (leaf) whose posting list was read, or an
+    operation on the lists of its children. Every node records its actual costs: the time it took, the number of skip
+    pointers followed and the size of the resulting posting list.
+    """
+    def __init__(self, label, children, postings, seconds=0.0, skips=0):
+        self.label = label
+        self.children = children
+        self.seconds = seconds
+        self.skips = skips
+
+        # the postings are counted right away, since the merges re-use (and re-link) the nodes of their input lists
+        self.size = sum(1 for _ in postings) if EXPLAIN else None
+
+    def lines(self, prefix='', child_prefix=''):
+        """
+        Returns the lines (str) of the tree rooted at this node, e.g.
+            AND  3 docs  0.052 ms  2 skips
+            ├── TERM gate  19 docs  0.110 ms
+            └── ...
+        """
+        costs = f'{self.size} docs  {1000 * self.seconds:.3f} ms'
+        if self.label.startswith(('AND', 'NOT')):
+            costs += f'  {self.skips} skips'
+
+        lines = [f'{prefix}{self.label}  {costs}']
+        for i, child in enumerate(self.children):
+            is_last = i == len(self.children) - 1
+            lines += child.lines(child_prefix + ('└── ' if is_last else '├── '),
+                                 child_prefix + ('    ' if is_last else '│   '))
+        return lines
+
+
+def explained_operation(list_a, list_b, operation, plan_a, plan_b, label=None):
+    """
+    Does exec_operation on the two lists and returns the resulting postings list together with its plan node.
+    plan_a and plan_b are the plan nodes of list_a and list_b.
+    """
+    skips_before = PostingList.skips_followed
+    start_time = time.perf_counter()
+
+    resulting_postings = exec_operation(list_a, list_b, operation)
+
+    seconds = time.perf_counter() - start_time
+    return resulting_postings, PlanNode(label or operation, [plan_a, plan_b], resulting_postings, seconds,
+                                        PostingList.skips_followed - skips_before)
+
+
+def explained_search_term(term_to_search, dictionary):
+    """
+    Does search_term and returns the posting list of the term together with its plan node (a leaf).
+    """
+    start_time = time.perf_counter()
+    postings = search_term(term_to_search, dictionary)
+    return postings, PlanNode(f'TERM {term_to_search}', [], postings, time.perf_counter() - start_time)
+
+
+def print_plan(query, RPN, plan, notes, seconds, skips):
+    """
+    Prints the plan tree of a query, that is how the query was actually evaluated (--explain).
+    """
+    print(f'query: {query.strip()}')
+    print(f'RPN:   {" ".join(RPN)}')
+
+    if plan is not None:
+        print('\n'.join(plan.lines()))
+
+    for note in notes:
+        print(f'note:  {note}')
+
+    print(f'total: {1000 * seconds:.3f} ms, {skips} skips\n')
+
+
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] +
+          " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results [--explain]")
 
 
 def exec_operation(listA, listB, operation):
@@ -337,60 +419,84 @@ def run_search(dict_file, postings_file, queries_file, results_file):
 
     with open(queries_file, 'r') as queries:
         for query in queries:
+            query_start_time = time.perf_counter()
+            query_skips_before = PostingList.skips_followed
             RPN = shunting_yard(query)  # Process this query
 
             # print(f'Searching for query: {query} which is translated to RPN: {RPN}')
 
             result = None  # we will iteratively write our results to this variable and it will
             # be the postings list we return in the end.
+            result_plan = None  # the plan tree of how result was evaluated, and the plan of last_term (--explain)
+            notes = []  # the operators of the query that were not applied (--explain)
             i = 0
             while i < len(RPN):
                 token = RPN[i]
 
                 if token in OPERATORS:
                     if token == 'AND':
-                        result = exec_operation(last_term, result, 'AND')
+                        result, result_plan = explained_operation(last_term, result, 'AND',
+                                                                  last_term_plan, result_plan)
                     elif token == 'OR':
-                        result = exec_operation(last_term, result, 'OR')
+                        result, result_plan = explained_operation(last_term, result, 'OR',
+                                                                  last_term_plan, result_plan)
                     elif token == 'NOT':
                         if i + 1 < len(RPN):
                             next_token = RPN[i+1]
                             if next_token in OPERATORS:
                                 if next_token == 'AND':
-                                    result = exec_operation(result, last_term, 'ANDNOT')
+                                    result, result_plan = explained_operation(result, last_term, 'ANDNOT',
+                                                                              result_plan, last_term_plan)
                                 elif next_token == 'OR':
                                     # all_docs_list is a posting list that contains ALL document id's in
                                     # sorted order. It is used to handle some (NOT term) queries, where we
                                     # use the all_docs_list and subtract all postings in the posting list of "term".
-                                    all_docs_list = search_term('all_documents_combined', dictionary)
-                                    not_last_term = exec_operation(all_docs_list, last_term, 'NOT')
-                                    result = exec_operation(result, not_last_term, 'OR')
+                                    all_docs_list, all_docs_plan = explained_search_term('all_documents_combined',
+                                                                                         dictionary)
+                                    not_last_term, not_last_term_plan = explained_operation(
+                                        all_docs_list, last_term, 'NOT', all_docs_plan, last_term_plan,
+                                        'NOT (all_documents_combined ANDNOT term)')
+                                    result, result_plan = explained_operation(result, not_last_term, 'OR',
+                                                                              result_plan, not_last_term_plan,
+                                                                              'OR (with NOT term)')
                                 elif next_token == 'NOT':  # double negation, so we can just use the value we had before
                                     result = result
+                                    notes.append(f'NOT NOT at position {i} is a double negation, nothing was done')
                                 i += 1  # if we used one of these, we skip an extra step in
                                 # this iteration since we used two operations at once
+                            else:
+                                notes.append(f'NOT at position {i} was not applied, '
+                                             f'it is followed by the term "{next_token}"')
                         else:
-                            all_docs_list = search_term('all_documents_combined', dictionary)
-                            result = exec_operation(all_docs_list, last_term, 'NOT')
+                            all_docs_list, all_docs_plan = explained_search_term('all_documents_combined',
+                                                                                 dictionary)
+                            result, result_plan = explained_operation(all_docs_list, last_term, 'NOT',
+                                                                      all_docs_plan, last_term_plan,
+                                                                      'NOT (all_documents_combined ANDNOT term)')
                 else:
-                    last_term = search_term(token, dictionary)
+                    last_term, last_term_plan = explained_search_term(token, dictionary)
                     if result is None:
                         # for the very first iteration, we do not have a result set yet,
                         # so we set it manually, and later it will keep on accumulating results
                         # from the queries while being processed.
                         result = last_term
+                        result_plan = last_term_plan
                 i += 1
 
             with open(results_file, 'a') as write_res:
                 write_res.write(str(result) + '\n')
 
+            if EXPLAIN:
+                print_plan(query, RPN, result_plan, notes, time.perf_counter() - query_start_time,
+                           PostingList.skips_followed - query_skips_before)
+
         print("... done with evaluating queries")
 
 
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
+dictionary_file = postings_file = file_of_queries = file_of_output = None
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:', ['explain'])
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -404,6 +510,8 @@ for o, a in opts:
         file_of_queries = a
     elif o == '-o':
         file_of_output = a
+    elif o == '--explain':
+        EXPLAIN = True
     else:
         assert False, "unhandled option"
 
@@ -4,9 +4,18 @@ import pickle
 import nltk
 import sys
 import getopt
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
 from heapq import heappop, heappush, heapify
 
 PORTER_STEMMER = nltk.stem.porter.PorterStemmer()
+WRITE_SCORES = False  # write the score of every result after its doc id, can be set with --scores
+
+tracer = None  # the QueryTracer if the queries are traced (-t), else None
+
+NO_TRACE_SPAN = nullcontext()
 
 
 class TrackScore:
@@ -15,8 +24,9 @@ class TrackScore:
         self.score = score
 
     def __str__(self):
-        # can uncomment the last lines for debugging of the scores.
-        return str(self.document_id)  # + " (" + str(self.score) + ")"
+        if WRITE_SCORES:
+            return str(self.document_id) + " (" + str(self.score) + ")"
+        return str(self.document_id)
 
     def __lt__(self, other):
         """
@@ -36,6 +46,98 @@ class TrackScore:
         return str(self.score)
 
 
+class QueryTracer:
+    """
+    Traces where the time of every query goes. The time of a query is split into the phases:
+        parse, dictionary, postings_io, unpickle, phrase (HW4 only), scoring, heap, write
+    where the time of a phase does not include the time of the phases (spans) nested in it, e.g. the postings that
+    are read while scoring count as postings_io and unpickle, not as scoring. The bytes read and the number of
+    postings decoded are also recorded for every term. Every query is written as a JSON line to the trace file.
+    The HW3 and HW4 search.py have identical copies of this class, so that every HW stays self-contained.
+    """
+    def __init__(self, file_path, dictionary, term_to_term_id, postings_file_path):
+        self.file = open(file_path, 'w')
+        self.latencies = []
+
+        self.term_id_to_term = {term_id: ' '.join(term) if isinstance(term, tuple) else term
+                                for term, term_id in term_to_term_id.items()}
+
+        # the length of every pickled posting list, such that reading and unpickling it can be timed separately
+        offsets = sorted(entry[1] for entry in dictionary.values()) + [os.path.getsize(postings_file_path)]
+        next_offsets = dict(zip(offsets, offsets[1:]))
+        self.postings_lengths = {term_id: next_offsets[entry[1]] - entry[1] for term_id, entry in dictionary.items()}
+
+    def start_query(self, query):
+        self.query = query.strip()
+        self.phase_times = {}
+        self.terms = {}
+        self.open_spans = []
+        self.query_start_time = time.perf_counter()
+
+    @contextmanager
+    def span(self, phase):
+        start_time = time.perf_counter()
+
+        if self.open_spans:
+            # the enclosing span is paused while this span is open
+            enclosing_phase, enclosing_start_time = self.open_spans[-1]
+            self.add_time(enclosing_phase, start_time - enclosing_start_time)
+
+        self.open_spans.append([phase, start_time])
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            _, span_start_time = self.open_spans.pop()
+            self.add_time(phase, end_time - span_start_time)
+
+            if self.open_spans:
+                self.open_spans[-1][1] = end_time
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] = self.phase_times.get(phase, 0) + seconds
+
+    def record_term(self, term_id, bytes_read, postings_decoded):
+        term = self.term_id_to_term[term_id]
+        if term not in self.terms:
+            self.terms[term] = {'bytes_read': 0, 'postings_decoded': 0}
+
+        self.terms[term]['bytes_read'] += bytes_read
+        self.terms[term]['postings_decoded'] += postings_decoded
+
+    def end_query(self):
+        latency = time.perf_counter() - self.query_start_time
+        self.latencies.append(latency)
+
+        self.file.write(json.dumps({'query': self.query, 'latency_ms': round(1000 * latency, 3),
+                                    'phases_ms': {phase: round(1000 * seconds, 3)
+                                                  for phase, seconds in self.phase_times.items()},
+                                    'terms': self.terms}) + '\n')
+
+    def finish(self):
+        """
+        Closes the trace file and prints the latency percentiles of the queries.
+        """
+        self.file.close()
+
+        if not self.latencies:
+            return
+
+        latencies = sorted(self.latencies)
+        percentiles = {p: latencies[min(len(latencies) - 1, math.ceil(p / 100 * len(latencies)) - 1)]
+                       for p in (50, 95, 99)}
+
+        print(f'Latency of {len(latencies)} queries: ' +
+              ', '.join(f'p{p} {1000 * latency:.2f} ms' for p, latency in percentiles.items()))
+
+
+def trace_span(phase):
+    """
+    Returns the span of a phase of the query that is being traced, or a span that does nothing if tracing is off.
+    """
+    return tracer.span(phase) if tracer is not None else NO_TRACE_SPAN
+
+
 def write_results_to_file(results_file, heap, number_of_results=10):
     # only write the top X results, or less if there isn't 10 good matches.
     number_of_results = number_of_results if len(heap) > number_of_results else len(heap)
@@ -51,12 +153,31 @@ def retrieve_postings_list(dictionary, term_id):
     Takes a term id and retrieves its posting list by using the dictionary to find the offset
     in the file the posting list was written to. Returns said postings list.
     """
+    if tracer is not None:
+        return retrieve_traced_postings_list(dictionary, term_id)
+
     with open(postings_file, 'rb') as read_postings:
         reader_offset = dictionary[term_id][1]
         read_postings.seek(reader_offset)
         return pickle.load(read_postings)
 
 
+def retrieve_traced_postings_list(dictionary, term_id):
+    """
+    retrieve_postings_list when tracing, the posting list is first read and then unpickled, so both can be timed.
+    """
+    with tracer.span('postings_io'):
+        with open(postings_file, 'rb') as read_postings:
+            read_postings.seek(dictionary[term_id][1])
+            pickled_posting_list = read_postings.read(tracer.postings_lengths[term_id])
+
+    with tracer.span('unpickle'):
+        posting_list = pickle.loads(pickled_posting_list)
+
+    tracer.record_term(term_id, len(pickled_posting_list), len(posting_list))
+    return posting_list
+
+
 def calculate_tf(term_frequency):
     return 1 + math.log10(term_frequency)
 
@@ -66,6 +187,9 @@ def calculate_idf(number_of_docs, document_frequency):
 
 
 def cosine_normalize_factor(weight_squared_sum):
+    if weight_squared_sum == 0:
+        # e.g. a query where every term is in every document (idf 0), all of its scores are 0 anyway
+        return 0
     return 1 / math.sqrt(weight_squared_sum)
 
 
@@ -83,18 +207,23 @@ def search_term(term_to_search, dictionary, term_to_term_id):
     Converts a term (str) to a posting list. Tries to first convert the term (str) to a term id (int) and
     then uses this term id to call a function that retrieves the posting list.
     """
-    if term_to_search not in term_to_term_id:
-        return []  # if the query term does not exist in dictionary, return an empty posting list
+    with trace_span('dictionary'):
+        if term_to_search not in term_to_term_id:
+            return []  # if the query term does not exist in dictionary, return an empty posting list
+
+        term_id = term_to_term_id[term_to_search]
 
-    term_id = term_to_term_id[term_to_search]
     return retrieve_postings_list(dictionary, term_id)
 
 
-def run_search(dict_file, postings_file, queries_file, results_file):
+def run_search(dict_file, postings_file, queries_file, results_file, trace_file=None):
     """
     using the given dictionary file and postings file,
     perform searching on the given queries file and output the results to a file
+
+    If trace_file is given, every query is traced (see QueryTracer) and the traces are written to this file.
     """
+    global tracer
     print('running search on the queries...')
 
     # create / wipe the results file before we start handling the queries
@@ -116,88 +245,107 @@ def run_search(dict_file, postings_file, queries_file, results_file):
     with open(queries_file, 'r') as queries:
         all_queries = queries.readlines()
 
+    if trace_file is not None:
+        tracer = QueryTracer(trace_file, dictionary, term_to_term_id, postings_file)
+
     for query in all_queries:
-        query_terms = []
-        split_q = query.split()
+        if tracer is not None:
+            tracer.start_query(query)
+
+        with trace_span('parse'):
+            query_terms = []
+            split_q = query.split()
+
+            for term in split_q:
+                query_terms.append(normalize_token(term))
+
+        with trace_span('scoring'):
+            scores_pre_normalize = {}
+            sum_weight_q = 0
 
-        for term in split_q:
-            query_terms.append(normalize_token(term))
+            for t in query_terms:
 
-        scores_pre_normalize = {}
-        sum_weight_q = 0
+                # --- IDF (QUERY) --- #
+                with trace_span('dictionary'):
+                    doc_freq = dictionary[term_to_term_id[t]][0] if t in term_to_term_id else None
 
-        for t in query_terms:
+                if doc_freq is not None:
+                    # idf query -> parameters: total number of documents and document frequency
+                    idf_qt = calculate_idf(number_of_docs, doc_freq)
+                else:
+                    # the idf for the query term is set to 0 if it appears in NO documents
+                    idf_qt = 0
 
-            # --- IDF (QUERY) --- #
-            if t in term_to_term_id:
-                term_id = term_to_term_id[t]
-                doc_freq = dictionary[term_id][0]
+                # --- TERM FREQUENCY (QUERY) --- #
+                term_freq_qt = query_terms.count(t)
+                tf_qt = calculate_tf(term_freq_qt)
 
-                # idf query -> parameters: total number of documents and document frequency
-                idf_qt = calculate_idf(number_of_docs, doc_freq)
-            else:
-                # the idf for the query term is set to 0 if it appears in NO documents
-                idf_qt = 0
+                # --- TF x IDF (QUERY) --- #
+                weight_qt = tf_qt * idf_qt
 
-            # --- TERM FREQUENCY (QUERY) --- #
-            term_freq_qt = query_terms.count(t)
-            tf_qt = calculate_tf(term_freq_qt)
+                # add this weight (squared) to the total squared weight of this query. This is used in cosine
+                # normalization
+                sum_weight_q += weight_qt**2
 
-            # --- TF x IDF (QUERY) --- #
-            weight_qt = tf_qt * idf_qt
+                # in case of no posting list belonging to query term t, this will always return an empty list "[]"
+                # which will be caught in the following if-statement.
+                posting_t = search_term(t, dictionary, term_to_term_id)
 
-            # add this weight (squared) to the total squared weight of this query. This is used in cosine normalization
-            sum_weight_q += weight_qt**2
+                # if this is a search query term that we do not have in our dictionary
+                # otherwise, the score contribution after multiplication will always be zero for this term.
+                if posting_t:
+                    for posting in posting_t:
+                        doc_id = posting[0]
 
-            # in case of no posting list belonging to query term t, this will always return an empty list "[]"
-            # which will be caught in the following if-statement.
-            posting_t = search_term(t, dictionary, term_to_term_id)
+                        if doc_id not in scores_pre_normalize:
+                            scores_pre_normalize[doc_id] = 0
 
-            # if this is a search query term that we do not have in our dictionary
-            # otherwise, the score contribution after multiplication will always be zero for this term.
-            if posting_t:
-                for posting in posting_t:
-                    doc_id = posting[0]
+                        term_freq_td = posting[1]
+                        tf_dt = calculate_tf(term_freq_td)
 
-                    if doc_id not in scores_pre_normalize:
-                        scores_pre_normalize[doc_id] = 0
+                        # accumulate the product of non-normalized wt_doc and wt_query for every document
+                        # this will later be normalized using cosine normalization.
+                        scores_pre_normalize[doc_id] += weight_qt * tf_dt
 
-                    term_freq_td = posting[1]
-                    tf_dt = calculate_tf(term_freq_td)
+        with trace_span('heap'):
+            lnc_ltc_heap = []
+            heapify(lnc_ltc_heap)
 
-                    # accumulate the product of non-normalized wt_doc and wt_query for every document
-                    # this will later be normalized using cosine normalization.
-                    scores_pre_normalize[doc_id] += weight_qt * tf_dt
+            for key, value in scores_pre_normalize.items():
+                # note: the document lengths was calculated during indexing and is used from a dictionary during search.
 
-        lnc_ltc_heap = []
-        heapify(lnc_ltc_heap)
+                normalized_score = value * cosine_normalize_factor(sum_weight_q) * \
+                    cosine_normalize_factor(documents_lengths[key])
 
-        for key, value in scores_pre_normalize.items():
-            # note: the document lengths was calculated during indexing and is used from a dictionary during search.
+                # TrackScore is a custom class that is used to be able to define our own definition of "<" and "="
+                # between objects and also the string representation of such objects.
+                new_score = TrackScore(key, normalized_score)
 
-            normalized_score = value * cosine_normalize_factor(sum_weight_q) * \
-                cosine_normalize_factor(documents_lengths[key])
+                # this max-heap have the score of ALL documents, uses the heapq (min-heap) module but turns into a
+                # max-heap by changing the definitions of lt and eq with TrackScore class.
+                heappush(lnc_ltc_heap, new_score)
 
-            # TrackScore is a custom class that is used to be able to define our own definition of "<" and "=" between
-            # objects and also the string representation of such objects.
-            new_score = TrackScore(key, normalized_score)
+        with trace_span('write'):
+            write_results_to_file(results_file, lnc_ltc_heap, 10)
 
-            # this max-heap have the score of ALL documents, uses the heapq (min-heap) module but turns into a
-            # max-heap by changing the definitions of lt and eq with TrackScore class.
-            heappush(lnc_ltc_heap, new_score)
+        if tracer is not None:
+            tracer.end_query()
 
-        write_results_to_file(results_file, lnc_ltc_heap, 10)
+    if tracer is not None:
+        tracer.finish()
+        tracer = None
 
 
 def usage():
-    print("usage: " +
-          sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries " +
+          "-o output-file-of-results [-t trace-file] [--scores]")
 
 
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
+dictionary_file = postings_file = file_of_queries = file_of_output = None
+file_of_trace = None
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:t:', ['scores'])
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -211,6 +359,10 @@ for o, a in opts:
         file_of_queries = a
     elif o == '-o':
         file_of_output = a
+    elif o == '-t':  # trace every query
+        file_of_trace = a
+    elif o == '--scores':  # e.g. to compare the scores with benchmarks/golden_results.py
+        WRITE_SCORES = True
     else:
         assert False, "unhandled option"
 
@@ -218,4 +370,4 @@ if dictionary_file == None or postings_file == None or file_of_queries == None o
     usage()
     sys.exit(2)
 
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
+run_search(dictionary_file, postings_file, file_of_queries, file_of_output, file_of_trace)
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+import os
+import pickle
+import re
+import sys
+import getopt
+import time
+
+import search
+
+"""
+Benchmarks the phrase query engine of search.py against the previous pairwise phrase intersection, which compared
+every position of one word with every position of the next word (O(m * n) per document). The phrase engine is timed
+both with only the positional index, and with the biword index (if the index was built with biwords, index.py -b).
+If the index was built with a suffix array (index.py -s), exact phrases are also timed with the suffix array.
+Every line in the file of phrases is a phrase query, e.g. "the court held that" or "fiduciary duty"/3.
+"""
+
+DEFAULT_REPETITIONS = 5
+
+
+def pairwise_phrase_intersection(p_1, p_2):
+    """
+    The previous phrase intersection, kept as a reference for the benchmark. Returns the documents where the word
+    of p_2 directly follows the word of p_1, in the same form as a term's posting list.
+    """
+    merged_postings = search.merge_boolean_query(p_1, p_2, True)
+
+    result_posting = []
+
+    i = 0
+    while i < len(merged_postings):
+        document_temp_list = [merged_postings[i][0], 0, [], 0]
+
+        positions_y = search.decode_positions(merged_postings[i + 1][2])
+
+        for position_x in search.decode_positions(merged_postings[i][2]):
+            for position_y in positions_y:
+                if position_x == position_y - 1:
+                    document_temp_list[1] += 1
+                    document_temp_list[2].append(position_y)
+
+        if document_temp_list[1]:
+            document_temp_list[2] = search.encode_positions(document_temp_list[2])
+            result_posting.append(document_temp_list)
+
+        i += 2
+
+    return result_posting
+
+
+def pairwise_phrase_query(phrase, dictionary, term_to_term_id):
+    """
+    Evaluates an exact phrase with the previous pairwise intersection, one word at a time in phrase order.
+    """
+    terms, _ = phrase
+
+    result = search.search_term(terms[0], dictionary, term_to_term_id, with_positions=True)
+
+    for term in terms[1:]:
+        result = pairwise_phrase_intersection(result, search.search_term(term, dictionary, term_to_term_id,
+                                                                         with_positions=True))
+
+    return result
+
+
+def time_phrase_query(phrase_query_function, phrase, dictionary, term_to_term_id, repetitions, use_biwords=False,
+                      use_suffix_array=False):
+    """
+    Runs a phrase query a number of times. Returns the resulting posting list and the best time in milliseconds.
+    """
+    best_time = float('inf')
+    result = []
+
+    search.USE_BIWORD_INDEX = use_biwords
+    search.USE_SUFFIX_ARRAY = use_suffix_array
+
+    for _ in range(repetitions):
+        start_time = time.perf_counter()
+        result = phrase_query_function(phrase, dictionary, term_to_term_id)
+        best_time = min(best_time, time.perf_counter() - start_time)
+
+    return result, best_time * 1000
+
+
+def run_benchmark(dict_file, phrases_file, repetitions):
+    with open(dict_file, 'rb') as read_dict:
+        dictionary = pickle.load(read_dict)
+
+    with open(search.TERM_CONVERSION_FILEPATH, 'rb') as read_term_converter:
+        term_to_term_id = pickle.load(read_term_converter)
+
+    with open(phrases_file, 'r') as phrases:
+        all_phrases = [line.strip() for line in phrases if line.strip()]
+
+    number_of_biwords = sum(1 for term in term_to_term_id if isinstance(term, tuple))
+    print(f'The index has {number_of_biwords} biwords.')
+
+    has_suffix_array = os.path.exists(search.SUFFIX_ARRAY_FILEPATH)
+    if has_suffix_array:
+        # the suffix array replaces the positions (and the biwords) when searching exact phrases
+        print(f'Suffix array: {os.path.getsize(search.SUFFIX_ARRAY_FILEPATH) / 2 ** 20:.1f} MiB, positions: '
+              f'{os.path.getsize(search.POSITIONS_FILEPATH) / 2 ** 20:.1f} MiB, postings: '
+              f'{os.path.getsize(search.postings_file) / 2 ** 20:.1f} MiB')
+        search.load_suffix_array()
+
+    print(f'{"phrase":<40} {"df (words)":<28} {"docs":>6} {"pairwise ms":>12} {"linear ms":>10} {"speedup":>8} '
+          f'{"biword ms":>10} {"speedup":>8}' + (f' {"suffix ms":>10} {"speedup":>8}' if has_suffix_array else ''))
+
+    for line in all_phrases:
+        match = re.fullmatch(r'\"(.+?)\"(/\d+)?', line)
+        if not match:
+            print(f'Skipping "{line}", it is not a phrase.')
+            continue
+
+        words = [search.normalize_token(word) for word in match.group(1).split()]
+        phrase = (tuple(words), int(match.group(2)[1:]) if match.group(2) else None)
+
+        document_frequencies = [search.search_dictionary(word, dictionary, term_to_term_id) for word in words]
+        document_frequencies = ','.join(str(entry[0]) if entry else '0' for entry in document_frequencies)
+
+        result, linear_time = time_phrase_query(search.handle_phrase_query, phrase, dictionary, term_to_term_id,
+                                                repetitions)
+
+        if match.group(2):
+            # there is no pairwise implementation of the proximity operator to compare with
+            pairwise_time_column = f'{"-":>12}'
+            speedup_column = f'{"-":>8}'
+        else:
+            _, pairwise_time = time_phrase_query(pairwise_phrase_query, phrase, dictionary, term_to_term_id,
+                                                 repetitions)
+            pairwise_time_column = f'{pairwise_time:>12.2f}'
+            speedup_column = f'{pairwise_time / linear_time:>7.1f}x'
+
+        biword_result, biword_time = time_phrase_query(search.handle_phrase_query, phrase, dictionary,
+                                                       term_to_term_id, repetitions, use_biwords=True)
+        assert len(biword_result) == len(result), f'The biword index gave a different result for {line}'
+
+        suffix_array_columns = ''
+        if has_suffix_array and not match.group(2):
+            suffix_array_result, suffix_array_time = time_phrase_query(search.handle_phrase_query, phrase, dictionary,
+                                                                       term_to_term_id, repetitions,
+                                                                       use_suffix_array=True)
+            assert suffix_array_result == result, f'The suffix array gave a different result for {line}'
+            suffix_array_columns = f' {suffix_array_time:>10.2f} {linear_time / suffix_array_time:>7.1f}x'
+        elif has_suffix_array:
+            suffix_array_columns = f' {"-":>10} {"-":>8}'
+
+        print(f'{line:<40} {document_frequencies:<28} {len(result):>6} {pairwise_time_column} '
+              f'{linear_time:>10.2f} {speedup_column} {biword_time:>10.2f} {linear_time / biword_time:>7.1f}x'
+              f'{suffix_array_columns}')
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-phrases [-r repetitions]")
+
+
+if __name__ == '__main__':
+    dictionary_file = postings_file = file_of_phrases = None
+    number_of_repetitions = DEFAULT_REPETITIONS
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:r:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            file_of_phrases = a
+        elif o == '-r':
+            number_of_repetitions = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file is None or postings_file is None or file_of_phrases is None:
+        usage()
+        sys.exit(2)
+
+    search.postings_file = postings_file  # search.py reads the postings from this (module) global
+    run_benchmark(dictionary_file, file_of_phrases, number_of_repetitions)
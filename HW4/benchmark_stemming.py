@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+import contextlib
+import io
+import os
+import pickle
+import sys
+import getopt
+import tempfile
+import time
+
+import index
+
+"""
+Benchmarks the indexing time with Porter stemming (index.USE_STEMMING) against the indexing time without stemming.
+The index is built in a temporary directory, first from the csv file (which also writes the corpus cache) and then
+from the corpus cache, where the whole vocabulary is stemmed up front (in parallel with -w).
+"""
+
+
+def time_build_index(in_file, use_stemming, preprocess_file, number_of_workers):
+    """
+    Builds the index in the current directory, without printing the progress of the indexer.
+    Returns the time it took in seconds and the size of the vocabulary of the index.
+    """
+    index.USE_STEMMING = use_stemming
+    index.PREPROCESS_FILE = preprocess_file
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        index.build_index(in_file, 'dictionary.txt', 'postings.txt', number_of_workers)
+    build_time = time.perf_counter() - start_time
+
+    with open(index.TERM_CONVERSION_FILEPATH, 'rb') as read_term_converter:
+        vocabulary_size = len(pickle.load(read_term_converter))
+
+    return build_time, vocabulary_size
+
+
+def run_benchmark(in_file, number_of_workers):
+    in_file = os.path.abspath(in_file)
+    working_directory = os.getcwd()
+
+    print(f'{"input":<14} {"stemming":<9} {"seconds":>8} {"vocabulary":>11} {"stemmed":>9}')
+
+    with tempfile.TemporaryDirectory() as index_directory:
+        os.chdir(index_directory)
+
+        try:
+            for preprocess_file in (True, False):
+                for use_stemming in (False, True):
+                    build_time, vocabulary_size = time_build_index(in_file, use_stemming, preprocess_file,
+                                                                   number_of_workers)
+
+                    stemmed_tokens = '-'
+                    if use_stemming:
+                        with open(index.STEMMING_TABLE_FILEPATH, 'rb') as read_stemming_table:
+                            stemmed_tokens = len(pickle.load(read_stemming_table))
+
+                    print(f'{"csv" if preprocess_file else "corpus cache":<14} {"on" if use_stemming else "off":<9} '
+                          f'{build_time:>8.2f} {vocabulary_size:>11} {stemmed_tokens:>9}')
+        finally:
+            os.chdir(working_directory)
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -i csv-of-documents [-w number-of-workers]")
+
+
+if __name__ == '__main__':
+    input_csv = None
+    workers = index.NUMBER_OF_WORKERS
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:w:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i':
+            input_csv = a
+        elif o == '-w':
+            workers = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if input_csv is None:
+        usage()
+        sys.exit(2)
+
+    run_benchmark(input_csv, workers)
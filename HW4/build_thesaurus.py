@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+import os
+import pickle
+import sys
+import getopt
+import time
+
+import nltk
+
+"""
+Precomputes the thesaurus used by the query expansion of search.py (USE_THESAURUS_QE), such that WordNet does not
+have to be loaded while searching. For every term in the vocabulary of the index, the senses of the term are looked up
+in WordNet, and the tokenized definition (signature) and synonyms of every sense are saved in the thesaurus file.
+
+If the index is stemmed, its terms are Porter stems (e.g. "damag"), which WordNet mostly does not know. The raw tokens
+of the stemming table (e.g. "damages", "damaged") are looked up instead, like the query expansion looks up the raw
+query words.
+"""
+
+TERM_CONVERSION_FILEPATH = 'term_conversion.txt'
+STEMMING_TABLE_FILEPATH = 'stemming_table.txt'  # raw token -> stem, written by index.py if stemming is used
+THESAURUS_FILEPATH = 'thesaurus.txt'
+
+MIN_COVERAGE = 0.5  # a warning is printed if fewer of the terms of the index than this have WordNet senses
+
+SYNONYMS_PER_SENSE = 2  # a sense only needs one synonym that differs from the term itself, so keep at most two
+
+
+def sense_entry(sense, signature_token_to_id):
+    """
+    Converts a WordNet sense to (signature, synonyms) where the signature is a tuple of the token ids of the
+    tokenized definition of the sense, and synonyms is a tuple of the first alphabetic lemma names of the sense.
+    """
+    signature = set()
+    for token in nltk.tokenize.word_tokenize(sense.definition()):
+        if token not in signature_token_to_id:
+            signature_token_to_id[token] = len(signature_token_to_id)
+        signature.add(signature_token_to_id[token])
+
+    synonyms = [lemma.name() for lemma in sense.lemmas() if lemma.name().isalpha()]
+
+    return tuple(sorted(signature)), tuple(synonyms[:SYNONYMS_PER_SENSE])
+
+
+def build_thesaurus(vocabulary):
+    """
+    Returns the thesaurus of the vocabulary:
+        term -> list of (signature, synonyms), one for each WordNet sense of the term, in WordNet order
+    and the mapping signature token -> token id that the signatures are made of.
+    Terms without any WordNet sense are not in the thesaurus.
+    """
+    thesaurus = {}
+    signature_token_to_id = {}
+
+    for term in vocabulary:
+        senses = nltk.corpus.wordnet.synsets(term)
+
+        if senses:
+            thesaurus[term] = [sense_entry(sense, signature_token_to_id) for sense in senses]
+
+    return thesaurus, signature_token_to_id
+
+
+def run_build_thesaurus(thesaurus_file):
+    with open(TERM_CONVERSION_FILEPATH, 'rb') as read_term_converter:
+        term_to_term_id = pickle.load(read_term_converter)
+
+    # the biwords of the index (tuples of two words) are not looked up
+    index_terms = [term for term in term_to_term_id if isinstance(term, str)]
+
+    if os.path.exists(STEMMING_TABLE_FILEPATH):
+        # the raw token -> stem of every token of the index, the raw tokens are looked up instead of the stems
+        with open(STEMMING_TABLE_FILEPATH, 'rb') as read_stemming_table:
+            token_to_term = pickle.load(read_stemming_table)
+    else:
+        token_to_term = {term: term for term in index_terms}
+
+    vocabulary = list(token_to_term)
+
+    start_time = time.time()
+    thesaurus, signature_token_to_id = build_thesaurus(vocabulary)
+
+    with open(thesaurus_file, 'wb') as write_thesaurus:
+        pickle.dump(signature_token_to_id, write_thesaurus)
+        pickle.dump(thesaurus, write_thesaurus)
+
+    print(f'Looked up {len(vocabulary)} terms in {time.time() - start_time:.1f} s, {len(thesaurus)} of them have '
+          f'senses ({sum(len(senses) for senses in thesaurus.values())} senses, {len(signature_token_to_id)} '
+          f'signature tokens)')
+
+    # a term of the index is covered if one of its raw tokens has senses
+    covered_terms = {token_to_term[token] for token in thesaurus}
+    coverage = len(covered_terms) / max(len(index_terms), 1)
+    print(f'{len(covered_terms)} of the {len(index_terms)} terms of the index ({100 * coverage:.1f}%) have senses')
+
+    if coverage < MIN_COVERAGE:
+        print(f'Warning: only {100 * coverage:.1f}% of the terms of the index have WordNet senses, the query expansion '
+              f'will leave most query terms as they are', file=sys.stderr)
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " [-t thesaurus-file]")
+
+
+if __name__ == '__main__':
+    output_thesaurus_file = THESAURUS_FILEPATH
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 't:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-t':
+            output_thesaurus_file = a
+        else:
+            assert False, "unhandled option"
+
+    run_build_thesaurus(output_thesaurus_file)
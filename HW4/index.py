@@ -7,19 +7,77 @@ import nltk
 import sys
 import getopt
 import csv
+import json
+import mmap
+import struct
+import multiprocessing
+import tracemalloc
+from array import array
+from collections import deque
+from heapq import merge
+from itertools import chain, islice
+
+import numpy as np
 
 
 PORTER_STEMMER = nltk.stem.porter.PorterStemmer()
 STOP_WORDS = set(nltk.corpus.stopwords.words('english') + [".", ",", ";", ":"])
 
-DATAFRAME_PROCESSED_FILEPATH = 'dataframe_processed.csv'
+CORPUS_CACHE_FILEPATH = 'corpus_cache.bin'
 DOCUMENT_LENGTHS_FILEPATH = 'document_lengths.txt'
+DOCUMENT_IDS_FILEPATH = 'document_ids.txt'  # doc number -> case id (doc id in the csv file)
 TERM_CONVERSION_FILEPATH = 'term_conversion.txt'
-
-PREPROCESS_FILE = True
+POSITIONS_FILEPATH = 'positions.txt'
+SUFFIX_ARRAY_FILEPATH = 'suffix_array.bin'
+STEMMING_TABLE_FILEPATH = 'stemming_table.txt'  # raw token -> stem, written if stemming is used
+RUN_FILEPATH = 'positional_run_{}.txt'  # formatted with the run number
+CHECKPOINT_FILEPATH = 'index_checkpoint.txt'
+
+PREPROCESS_FILE = True  # set to False to index from the corpus cache of a previous run instead of the csv file
+WRITE_CORPUS_CACHE = True  # set to False to stream documents straight into the index without writing the cache
 WRITE_INDEX_TO_FILE = True
 USE_STEMMING = False
 
+# the number of positions that may be kept in memory before the in-memory postings are flushed to a run on disk
+MAX_POSITIONS_IN_MEMORY = 20_000_000
+
+# the postings are also flushed to a run, and a checkpoint is written, after every CHECKPOINT_INTERVAL documents.
+# An interrupted indexing can then be continued from the last checkpoint with --resume. None -> no checkpoints.
+CHECKPOINT_INTERVAL = 2500
+# the arrays that grow with every document are appended to side files of the checkpoint (CHECKPOINT_FILEPATH.<name>)
+CHECKPOINT_ARRAY_TYPECODES = {'document_ids': 'I', 'documents_lengths': 'd', 'term_stream': 'I', 'document_starts': 'I'}
+
+# with -t, a telemetry record (JSON line) is written every TELEMETRY_INTERVAL_DOCUMENTS documents or
+# TELEMETRY_INTERVAL_SECONDS seconds, whichever comes first. TELEMETRY_TRACEMALLOC also traces the peak memory that is
+# allocated by Python objects, which makes the indexing noticeably slower.
+TELEMETRY_INTERVAL_DOCUMENTS = 1000
+TELEMETRY_INTERVAL_SECONDS = 30
+TELEMETRY_TRACEMALLOC = False
+
+# number of processes that tokenize and normalize csv rows (1 -> no worker pool), can be set with -w
+NUMBER_OF_WORKERS = 1
+ROWS_PER_CHUNK = 64  # rows sent to a worker at a time
+CHUNKS_PER_WORKER = 4  # chunks that may be queued or done per worker before the indexer has consumed them
+STEMMING_CHUNK_SIZE = 1024  # distinct tokens sent to a worker at a time when the vocabulary is stemmed in parallel
+
+# minimum number of documents a biword (pair of adjacent terms) should appear in to be indexed, can be set with -b.
+# None -> no biword index, 0 -> all biwords are indexed.
+BIWORD_MIN_FREQUENCY = None
+
+# header of the corpus cache: magic, number of documents, vocabulary size and the byte offsets of the token ids,
+# the document table and the vocabulary table.
+CORPUS_CACHE_MAGIC = b'HW4CORP1'
+CORPUS_CACHE_HEADER = struct.Struct('<8s5Q')
+
+# set to True (or use -s) to also build a suffix array over the term ids of all documents, for phrase search.
+# The suffixes are sorted on (at least) their first SUFFIX_ARRAY_DEPTH terms, longer phrases are verified in search.
+BUILD_SUFFIX_ARRAY = False
+SUFFIX_ARRAY_DEPTH = 16
+
+# header of the suffix array file: magic, number of terms in the term stream, number of documents and the depth
+SUFFIX_ARRAY_MAGIC = b'HW4SUFX1'
+SUFFIX_ARRAY_HEADER = struct.Struct('<8s3Q')
+
 
 def create_ngram(sentence, n):
     """
@@ -32,21 +90,47 @@ def create_ngram(sentence, n):
     return [sentence[i:i + n] for i in range(len(sentence) - n + 1)]
 
 
+def encode_positions(positions):
+    """
+    Gap-encodes a sorted list of positions and writes every gap as a varint (7 bits per byte, the high bit is set
+    on every byte except the last one of a gap). Returns the encoded positions (bytes).
+    Example: [3, 130, 131] -> gaps [3, 127, 1] -> bytes 0x03 0x7f 0x01
+    """
+    encoded_positions = bytearray()
+    previous_position = 0
+
+    for position in positions:
+        gap = position - previous_position
+        previous_position = position
+
+        while gap >= 0x80:
+            encoded_positions.append((gap & 0x7F) | 0x80)
+            gap >>= 7
+        encoded_positions.append(gap)
+
+    return bytes(encoded_positions)
+
+
 def add_skip_ptrs(posting_list, length_of_posting_list):
     """
-    Takes a list of tuples [(doc_id, doc_freq), (doc_id, doc_freq), ...]
-    and returns a list of triples [(doc_id, doc_freq, index_of_skip), (doc_id, doc_freq, 0), ...]
+    Takes an iterable of pairs [(doc_id, [positions]), (doc_id, [positions]), ...] of known length
+    and returns a list [[doc_id, term_freq, positions_offset, index_of_skip], [doc_id, term_freq, positions_offset, 0]]
     where index_of_skip is the index of the pointers destination in the list, and 0 if this posting does not have
-    a skip pointer.
+    a skip pointer. Since the length is known beforehand, the skip pointers are added while iterating.
+
+    The positions are varint encoded (see encode_positions) and concatenated to a positions block that is returned
+    together with the list, positions_offset is where the posting's positions start in this block.
     """
     postings_list_with_skip_ptr = []
+    positions_block = bytearray()
 
     skips_to_add = math.floor(math.sqrt(length_of_posting_list))
     skip_distance = math.floor(length_of_posting_list / skips_to_add)
 
     position_index = 0
-    for key, value in posting_list.items():
-        postings_list_with_skip_ptr.append([key, len(value), value, 0])
+    for key, value in posting_list:
+        postings_list_with_skip_ptr.append([key, len(value), len(positions_block), 0])
+        positions_block += encode_positions(value)
 
         if position_index % skip_distance == 0 and position_index != length_of_posting_list - 1 \
                 and position_index + skip_distance < length_of_posting_list:
@@ -54,7 +138,7 @@ def add_skip_ptrs(posting_list, length_of_posting_list):
 
         position_index += 1
 
-    return postings_list_with_skip_ptr
+    return postings_list_with_skip_ptr, positions_block
 
 
 def calculate_tf(term_frequency):
@@ -65,6 +149,20 @@ def normalize_token(token):
     """
     Case-folds and porter-stems a token (str word). Returns a normalized token (str word).
     """
+    token = strip_token(token)
+
+    # currently not using any stemming due to the time complexity of this operation
+    if USE_STEMMING:
+        token = PORTER_STEMMER.stem(token)  # porter-stemming
+
+    return token
+
+
+def strip_token(token):
+    """
+    Case-folds a token (str word) and removes its leading and trailing non-alphanumeric characters. This is the part
+    of the normalization that does not depend on the index settings, and hence what is stored in the corpus cache.
+    """
     token = token.lower()  # case folding
 
     # removes leading and trailing non-alphanumeric characters
@@ -82,13 +180,7 @@ def normalize_token(token):
             r_idx = i
             break
 
-    token = token[l_idx: r_idx + 1]
-
-    # currently not using any stemming due to the time complexity of this operation
-    if USE_STEMMING:
-        token = PORTER_STEMMER.stem(token)  # porter-stemming
-
-    return token
+    return token[l_idx: r_idx + 1]
 
 
 def normalize_words_in_list(list_of_words):
@@ -96,12 +188,25 @@ def normalize_words_in_list(list_of_words):
 
 
 def create_positional_index(content, document_id, term_id, term_to_term_id, term_id_to_term,
-                            dictionary, postings_list, document_weights):
+                            dictionary, postings_list, index_biwords=False):
     """
     Create a postings list with positional indices. Goal is to have a dictionary where
-    we have a term_id as key:
-    dict[term_id] = doc_id:[54, 1337], doc_id: [123, 456, 789]
+    we have a term_id as key, and the documents and positions of the term as a compact array of uint32 as value:
+    dict[term_id] = array('I', [doc_id, 2, 54, 1337, doc_id, 3, 123, 456, 789])
+    where every document is a run of its doc id (the dense doc number), its number of positions and the positions.
+
+    If index_biwords is set, every pair of adjacent terms (a biword) is also given a term id, with the tuple
+    (first_term, second_term) as its term, and a postings list with the positions of its first term.
+
+    Returns the next unused term id and the term frequencies of the (single) terms in the document, biwords are
+    not counted in the document weights.
     """
+    # term id -> positions in this document, the positions of a term are only added to its array when the
+    # document is done. The terms are kept in order of their first occurrence.
+    document_positions = {}
+
+    previous_token = None
+
     positional_idx = 0
     for token in content:
         positional_idx += 1
@@ -114,101 +219,737 @@ def create_positional_index(content, document_id, term_id, term_to_term_id, term
 
         tokens_term_id = term_to_term_id[token]
 
-        if tokens_term_id not in dictionary:
-            # first time seeing it, so it has only been seen in the current document (i.e. doc freq = 1)
-            dictionary[tokens_term_id] = 1
-
-            postings_list[tokens_term_id] = {document_id: [positional_idx]}
-            # initialise the dictionary that maps doc_ids to positions.
-
-            document_weights[tokens_term_id] = 1
+        if tokens_term_id not in document_positions:
+            document_positions[tokens_term_id] = [positional_idx]
         else:
-            # first time seeing this term for this document
-            if document_id not in postings_list[tokens_term_id]:
-                dictionary[tokens_term_id] += 1  # only increment for first occurrence in each document
+            document_positions[tokens_term_id].append(positional_idx)
+
+        if index_biwords and previous_token is not None:
+            biword = (previous_token, token)
 
-                # since we process the documents in a sorted order, we can always append new documents to
-                # the list and it will still be in a sorted order.
-                postings_list[tokens_term_id][document_id] = [positional_idx]
+            if biword not in term_to_term_id:
+                term_to_term_id[biword] = term_id
+                term_id_to_term[term_id] = biword
+                term_id += 1
 
-                document_weights[tokens_term_id] = 1
+            biword_id = term_to_term_id[biword]
 
+            if biword_id not in document_positions:
+                document_positions[biword_id] = [positional_idx - 1]
             else:
-                # if we have already seen this token in this posting already,
-                # then we should add the current position to the list.
-                postings_list[tokens_term_id][document_id].append(positional_idx)
+                document_positions[biword_id].append(positional_idx - 1)
+
+        previous_token = token
+
+    term_frequencies = []
+
+    for tokens_term_id, positions in document_positions.items():
+        # the term may already have a document frequency from earlier documents (also ones flushed to earlier runs).
+        dictionary[tokens_term_id] = dictionary.get(tokens_term_id, 0) + 1
+
+        if tokens_term_id not in postings_list:
+            postings_list[tokens_term_id] = array('I')
+
+        # since we process the documents in order of doc number, the runs of a term are always in a sorted order.
+        term_postings = postings_list[tokens_term_id]
+        term_postings.append(document_id)
+        term_postings.append(len(positions))
+        term_postings.extend(positions)
 
-                # this dictionary is used for storing length of documents, initialised to 1
-                document_weights[tokens_term_id] += 1
+        if not index_biwords or not isinstance(term_id_to_term[tokens_term_id], tuple):
+            term_frequencies.append(len(positions))
 
-    return term_id
+    return term_id, term_frequencies
 
 
-def calculate_document_weight(document_weight, out_dictionary, document_id):
+def iterate_postings(term_postings):
+    """
+    Yields the (doc_id, positions) pairs of the compact postings array of a term (see create_positional_index).
+    """
+    idx = 0
+    while idx < len(term_postings):
+        number_of_positions = term_postings[idx + 1]
+        yield term_postings[idx], term_postings[idx + 2:idx + 2 + number_of_positions]
+        idx += 2 + number_of_positions
+
+
+def calculate_document_weight(term_frequencies):
     # for every document, the weighted length of document is calculated for use when processing search queries.
     doc_wt_sum = 0
-    for value in document_weight.values():
+    for value in term_frequencies:
         tf_doc = calculate_tf(value)
         doc_wt_sum += tf_doc ** 2
-    out_dictionary[document_id] = doc_wt_sum
+    return doc_wt_sum
 
 
-def pre_process_file(in_file_path):
+def write_run(postings_list, run_number):
     """
-    Takes the file path to a .csv file, reads this file and converts it to a Pandas dataframe. Then writes this
-    dataframe to a file for use when indexing.
+    SPIMI: writes the in-memory positional postings to a run file on disk, sorted by term id. Every term is
+    pickled separately as a tuple (term_id, array of postings) so that the run can be read back one term at
+    a time when merging. Returns the file path of the run.
     """
+    run_file_path = RUN_FILEPATH.format(run_number)
 
-    # increase maximum field size to solve the following error:
-    # _csv.Error: field larger than field limit (131072)
-    csv.field_size_limit(sys.maxsize)
+    with open(run_file_path, 'wb') as write_run_file:
+        for term_id in sorted(postings_list):
+            pickle.dump((term_id, postings_list[term_id]), write_run_file)
+
+    return run_file_path
+
+
+def read_run(run_file_path):
+    """
+    Lazily yields the (term_id, array of postings) tuples of a run file, in sorted order of term id.
+    """
+    with open(run_file_path, 'rb') as read_run_file:
+        while True:
+            try:
+                yield pickle.load(read_run_file)
+            except EOFError:
+                return
+
+
+def merge_runs(runs, dictionary):
+    """
+    k-way merges the runs (iterables of (term_id, array of postings) sorted by term id) into complete
+    posting lists. The runs must be given in the order they were created, so that the documents of a term stay in
+    the order they were indexed. Since the document frequency of every term is already known from the dictionary,
+    the skip pointers are added while merging. Yields (term_id, (posting list with skip pointers, positions block))
+    in order of term id.
+    """
+    current_term_id = None
+    current_postings = []
+
+    # heapq.merge breaks ties by the order of the runs, which keeps the documents of a term in indexing order
+    for term_id, postings in merge(*runs, key=lambda run_entry: run_entry[0]):
+        if term_id != current_term_id and current_postings:
+            yield current_term_id, add_skip_ptrs(chain.from_iterable(current_postings),
+                                                 dictionary[current_term_id])
+            current_postings = []
+
+        current_term_id = term_id
+        current_postings.append(iterate_postings(postings))
+
+    if current_postings:
+        yield current_term_id, add_skip_ptrs(chain.from_iterable(current_postings), dictionary[current_term_id])
+
+
+def build_suffix_array(term_stream, depth=SUFFIX_ARRAY_DEPTH):
+    """
+    Builds a suffix array over a stream (array) of term ids by prefix doubling: the suffixes are first sorted on
+    their first term, then on their first 2, 4, 8, ... terms, where every round sorts on the ranks (from the previous
+    round) of the first and second half. Stops when all suffixes have distinct ranks or when they are sorted on at
+    least depth terms. Returns the suffix array (uint32 NumPy array of start positions in the term stream).
+
+    Every round is a stable NumPy argsort of one int64 key per suffix (rank of the first half * (max rank + 2) + rank
+    of the second half + 1), so suffixes with the same first depth terms stay in order of position. The ranks are
+    uint32, which keeps the peak memory at about 30 bytes per term.
+    Time Complexity: O(n log(n) log(depth))
+    """
+    number_of_terms = len(term_stream)
+    rank = np.frombuffer(term_stream, dtype=np.uint32).copy()  # the rank of a suffix is at first just its first term id
+    suffix_array = np.argsort(rank, kind='stable')
 
-    csvreader = csv.reader(open(in_file_path, 'r'))
-    header = next(csvreader)
+    sorted_depth = 1
+    while sorted_depth < depth and number_of_terms > 1:
+        # suffixes that end before sorted_depth more terms get the lowest rank for their second half
+        keys = rank.astype(np.int64)
+        keys *= int(rank.max()) + 2
+        keys[:number_of_terms - sorted_depth] += rank[sorted_depth:]
+        keys[:number_of_terms - sorted_depth] += 1
 
-    csvreader = list(csvreader)
+        suffix_array = np.argsort(keys, kind='stable')
+        keys = keys[suffix_array]
 
-    df = []
-    for row in csvreader:
-        # The regexp tokenization is benchmarked to be much faster than what was implemented before:
-        # src: https://towardsdatascience.com/benchmarking-python-nlp-tokenizers-3ac4735100c5
+        # the rank of a suffix is the number of distinct keys before its key
+        is_new_key = keys[1:] != keys[:-1]
+        del keys
+        rank[suffix_array[0]] = 0
+        rank[suffix_array[1:]] = np.cumsum(is_new_key, dtype=np.uint32)
+        del is_new_key
 
-        tokenized_content = nltk.regexp_tokenize(row[2], pattern='\s+', gaps=True)
+        sorted_depth *= 2
 
-        normalized_content = normalize_words_in_list(tokenized_content)
+        if rank[suffix_array[-1]] == number_of_terms - 1:
+            break  # all suffixes are different, sorting on more terms would not change the order
 
-        df.append([int(row[0]), normalized_content])  # add doc id and normalized & tokenized content fields
+    return suffix_array.astype(np.uint32)
 
-    with open(DATAFRAME_PROCESSED_FILEPATH, 'w') as df_file:
-        write = csv.writer(df_file)
-        write.writerow([header[0], header[2]])  # write the header field to the file.
-        write.writerows(df)  # write the doc_id, processed content fields to the file.
 
-    print(f'Wrote the processed dataframe to file.')
-    return df
+def write_suffix_array(term_stream, document_starts, document_ids, file_path=SUFFIX_ARRAY_FILEPATH):
+    """
+    Builds the suffix array of the term stream and writes it to a file that is mmap-ed by search.py:
+        header          ->  SUFFIX_ARRAY_HEADER
+        term stream     ->  uint32 term id for every term of every document, every document is followed by a 0
+        suffix array    ->  uint32 start position in the term stream of every suffix, in sorted order
+        document starts ->  uint32 position in the term stream where every document starts
+        document ids    ->  uint32 case id of every document, the documents are in order of doc number
+    """
+    start_time = time.time()
+    suffix_array = build_suffix_array(term_stream)
+
+    with open(file_path, 'wb') as write_suffix_array_file:
+        write_suffix_array_file.write(SUFFIX_ARRAY_HEADER.pack(SUFFIX_ARRAY_MAGIC, len(term_stream),
+                                                               len(document_ids), SUFFIX_ARRAY_DEPTH))
+        term_stream.tofile(write_suffix_array_file)
+        suffix_array.tofile(write_suffix_array_file)
+        document_starts.tofile(write_suffix_array_file)
+        document_ids.tofile(write_suffix_array_file)
+        file_size = write_suffix_array_file.tell()
+
+    print(f'Built the suffix array of {len(term_stream)} terms in {time.time() - start_time:.1f} s, '
+          f'it takes {file_size} bytes')
 
 
-def open_processed_file(file_path=DATAFRAME_PROCESSED_FILEPATH):
+def read_csv_rows(in_file_path, telemetry=None):
+    """
+    Takes the file path to a .csv file and lazily yields one row (list of str fields) at a time, so that the full
+    dataset never has to be held in memory. The header row is skipped. The share of the file that has been read is
+    reported to the telemetry (if any), for its estimate of the remaining time.
+    """
 
     # increase maximum field size to solve the following error:
     # _csv.Error: field larger than field limit (131072)
     csv.field_size_limit(sys.maxsize)
 
-    csvreader = csv.reader(open(file_path, 'r'))
-    header = next(csvreader)
+    file_size = os.path.getsize(in_file_path)
+
+    with open(in_file_path, 'r') as in_file:
+        csvreader = csv.reader(in_file)
+        next(csvreader)  # skip the header
+
+        for rows_read, row in enumerate(csvreader, 1):
+            if telemetry is not None:
+                telemetry.report_input_read(rows_read, in_file.buffer.tell() / file_size)
+            yield row
+
+
+def process_row(row):
+    """
+    Tokenizes and strips the content field of a single csv row. Returns [doc_id, stripped_content], where the
+    content is not yet stemmed.
+    """
+    # The regexp tokenization is benchmarked to be much faster than what was implemented before:
+    # src: https://towardsdatascience.com/benchmarking-python-nlp-tokenizers-3ac4735100c5
+    tokenized_content = nltk.regexp_tokenize(row[2], pattern='\s+', gaps=True)
+
+    return [int(row[0]), [strip_token(token) for token in tokenized_content]]
+
+
+def process_rows(rows):
+    """
+    Worker function for the worker pool, processes a chunk of csv rows with process_row.
+    """
+    return [process_row(row) for row in rows]
+
+
+def process_rows_in_parallel(rows, number_of_workers):
+    """
+    Tokenizes and strips the csv rows in chunks across a pool of worker processes. Yields the processed rows in
+    the same (document) order as they were read. At most CHUNKS_PER_WORKER chunks per worker are submitted ahead
+    of the indexer, so the memory stays bounded even if the workers are faster than the indexing.
+    """
+    start_time = time.time()
+    waiting_time = 0
+    number_of_rows = 0
+    max_pending_chunks = number_of_workers * CHUNKS_PER_WORKER
+
+    with multiprocessing.Pool(number_of_workers) as pool:
+        pending_chunks = deque()
+
+        while True:
+            chunk = list(islice(rows, ROWS_PER_CHUNK))
+            if chunk:
+                pending_chunks.append(pool.apply_async(process_rows, (chunk,)))
 
-    df = list(csvreader)
-    for i in range(len(df)):
-        df[i][0] = int(df[i][0])
+            if not pending_chunks:
+                break
 
-    return df
+            if len(pending_chunks) >= max_pending_chunks or not chunk:
+                # the oldest chunk is always returned first, this keeps the documents in order.
+                waiting_start_time = time.time()
+                processed_rows = pending_chunks.popleft().get()
+                waiting_time += time.time() - waiting_start_time
 
+                number_of_rows += len(processed_rows)
+                yield from processed_rows
 
-def build_index(in_file, out_dict, out_postings):
+    print_tokenization_throughput(number_of_rows, number_of_workers, time.time() - start_time, waiting_time)
+
+
+def process_rows_serially(rows):
+    """
+    Tokenizes and strips the csv rows one at a time in this process. Yields the processed rows.
+    """
+    start_time = time.time()
+    tokenization_time = 0
+    number_of_rows = 0
+
+    for row in rows:
+        tokenization_start_time = time.time()
+        processed_row = process_row(row)
+        tokenization_time += time.time() - tokenization_start_time
+
+        number_of_rows += 1
+        yield processed_row
+
+    print_tokenization_throughput(number_of_rows, 1, time.time() - start_time, tokenization_time)
+
+
+def print_tokenization_throughput(number_of_rows, number_of_workers, total_time, waiting_time):
+    """
+    Reports the tokenization throughput for a worker count. The waiting time is the time the indexer spent
+    waiting for tokenized rows, i.e. how much tokenization still slows down the indexing.
+    """
+    print(f'Tokenized {number_of_rows} documents with {number_of_workers} worker(s) in {total_time:.2f} s, the '
+          f'indexer waited {waiting_time:.2f} s for tokenized rows '
+          f'({number_of_rows / max(waiting_time, 1e-9):.1f} docs/s on the indexing path)')
+
+
+def stem_token(token):
+    """
+    Porter-stems a single (already stripped) token, the worker function when a vocabulary is stemmed in parallel.
+    """
+    return PORTER_STEMMER.stem(token)
+
+
+def stem_vocabulary(vocabulary, number_of_workers=1):
+    """
+    Porter-stems every token of a vocabulary (list of distinct tokens) once, across a pool of worker processes if
+    number_of_workers > 1. Returns the stems in the same order as the vocabulary.
+    """
+    if number_of_workers > 1:
+        with multiprocessing.Pool(number_of_workers) as pool:
+            return pool.map(stem_token, vocabulary, chunksize=STEMMING_CHUNK_SIZE)
+
+    return [stem_token(token) for token in vocabulary]
+
+
+def stem_content(content, stemming_table):
+    """
+    Porter-stems the (already stripped) tokens of a document if stemming is used, else returns the content as is.
+    The stems are looked up in the stemming table (raw token -> stem), a token is only stemmed (and added to the
+    table) the first time it is seen, so every distinct token is stemmed once.
+    """
+    if not USE_STEMMING:
+        return content
+
+    for token in content:
+        if token not in stemming_table:
+            stemming_table[token] = stem_token(token)
+
+    return [stemming_table[token] for token in content]
+
+
+def write_stemming_table(stemming_table, file_path=STEMMING_TABLE_FILEPATH):
+    """
+    Writes the stemming table (raw token -> stem) of the indexed vocabulary, search.py uses it to normalize the
+    query terms without stemming them again.
+    """
+    with open(file_path, 'wb') as write_stemming_table_file:
+        pickle.dump(stemming_table, write_stemming_table_file)
+
+
+def pre_process_file(in_file_path, number_of_workers=1, stemming_table=None, skip_rows=0, telemetry=None):
+    """
+    Takes the file path to a .csv file and streams it row by row through tokenization and normalization.
+    Yields one [doc_id, normalized_content] pair at a time, so only the document currently being indexed is kept
+    in memory (a bounded window of documents if a worker pool is used). If WRITE_CORPUS_CACHE is set, the stripped
+    tokens of every document are also written to the binary corpus cache, for use in later runs
+    (with PREPROCESS_FILE = False). The stems of the tokens are added to the stemming table (if stemming is used).
+    The first skip_rows rows are skipped without being tokenized, the corpus cache is then not written since it
+    would not hold the full corpus.
+    """
+    if stemming_table is None:
+        stemming_table = {}
+
+    csv_rows = islice(read_csv_rows(in_file_path, telemetry), skip_rows, None)
+
+    if number_of_workers > 1:
+        rows = process_rows_in_parallel(csv_rows, number_of_workers)
+    else:
+        rows = process_rows_serially(csv_rows)
+
+    if WRITE_CORPUS_CACHE and not skip_rows:
+        rows = write_corpus_cache(rows)
+
+    for doc_id, content in rows:
+        normalize_start_time = time.perf_counter()
+        content = stem_content(content, stemming_table)
+
+        if telemetry is not None:
+            telemetry.add_normalize_time(time.perf_counter() - normalize_start_time)
+
+        yield [doc_id, content]
+
+
+def write_corpus_cache(documents, file_path=CORPUS_CACHE_FILEPATH):
+    """
+    Writes the stripped tokens of every document to a binary corpus cache while passing the documents through.
+    The cache is laid out to be mmap-ed when read:
+        header          ->  CORPUS_CACHE_HEADER
+        token ids       ->  uint32 token id for every token of every document, documents are concatenated
+        document table  ->  uint32 doc id for every document, followed by uint64 offsets (in tokens) of where every
+                            document starts in the token ids, with one extra offset for the end of the last document
+        vocabulary      ->  uint64 byte offset of every token (+ 1 for the end), followed by the utf-8 tokens
+    """
+    token_to_token_id = {}
+    vocabulary = []
+    doc_ids = array('I')
+    doc_offsets = array('Q', [0])
+
+    with open(file_path, 'wb') as write_cache:
+        write_cache.write(bytes(CORPUS_CACHE_HEADER.size))  # the header is written when all offsets are known
+
+        for doc_id, content in documents:
+            token_ids = array('I')
+            for token in content:
+                if token not in token_to_token_id:
+                    token_to_token_id[token] = len(vocabulary)
+                    vocabulary.append(token)
+                token_ids.append(token_to_token_id[token])
+
+            token_ids.tofile(write_cache)
+            doc_ids.append(doc_id)
+            doc_offsets.append(doc_offsets[-1] + len(token_ids))
+
+            yield doc_id, content
+
+        doc_table_offset = pad_to_alignment(write_cache)
+        doc_ids.tofile(write_cache)
+        pad_to_alignment(write_cache)
+        doc_offsets.tofile(write_cache)
+
+        encoded_vocabulary = [token.encode('utf-8') for token in vocabulary]
+        vocabulary_offsets = array('Q', [0])
+        for encoded_token in encoded_vocabulary:
+            vocabulary_offsets.append(vocabulary_offsets[-1] + len(encoded_token))
+
+        vocabulary_offset = pad_to_alignment(write_cache)
+        vocabulary_offsets.tofile(write_cache)
+        write_cache.write(b''.join(encoded_vocabulary))
+
+        write_cache.seek(0)
+        write_cache.write(CORPUS_CACHE_HEADER.pack(CORPUS_CACHE_MAGIC, len(doc_ids), len(vocabulary),
+                                                   CORPUS_CACHE_HEADER.size, doc_table_offset, vocabulary_offset))
+
+    print(f'Wrote {len(doc_ids)} documents with a vocabulary of {len(vocabulary)} tokens to the corpus cache.')
+
+
+def pad_to_alignment(file, alignment=8):
+    """
+    Pads the file with zero bytes so that the next write starts at a multiple of the alignment. Returns the offset.
+    """
+    padding = -file.tell() % alignment
+    file.write(bytes(padding))
+    return file.tell()
+
+
+def open_corpus_cache(file_path=CORPUS_CACHE_FILEPATH, number_of_workers=1, stemming_table=None, skip_documents=0,
+                      telemetry=None):
+    """
+    Memory-maps a corpus cache written by write_corpus_cache and yields one [doc_id, normalized_content] pair at a
+    time, starting after the first skip_documents documents. If stemming is used, the whole vocabulary of the cache
+    is stemmed up front (in parallel if number_of_workers > 1) and added to the stemming table, the documents are
+    then rebuilt by mapping their token ids through the stemmed vocabulary.
+    """
+    with open(file_path, 'rb') as read_cache:
+        cache = mmap.mmap(read_cache.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, number_of_documents, vocabulary_size, tokens_offset, doc_table_offset, vocabulary_offset = \
+        CORPUS_CACHE_HEADER.unpack_from(cache)
+
+    if magic != CORPUS_CACHE_MAGIC:
+        raise ValueError(f'{file_path} is not a corpus cache')
+
+    doc_offsets_offset = doc_table_offset + 4 * number_of_documents
+    doc_offsets_offset += -doc_offsets_offset % 8
+    vocabulary_bytes_offset = vocabulary_offset + 8 * (vocabulary_size + 1)
+
+    cache_view = memoryview(cache)
+    token_ids = cache_view[tokens_offset:doc_table_offset].cast('I')
+    doc_ids = cache_view[doc_table_offset:doc_table_offset + 4 * number_of_documents].cast('I')
+    doc_offsets = cache_view[doc_offsets_offset:doc_offsets_offset + 8 * (number_of_documents + 1)].cast('Q')
+    vocabulary_offsets = cache_view[vocabulary_offset:vocabulary_bytes_offset].cast('Q')
+
+    vocabulary = [cache[vocabulary_bytes_offset + vocabulary_offsets[i]:
+                        vocabulary_bytes_offset + vocabulary_offsets[i + 1]].decode('utf-8')
+                  for i in range(vocabulary_size)]
+    if USE_STEMMING:
+        normalize_start_time = time.perf_counter()
+        stems = stem_vocabulary(vocabulary, number_of_workers)
+
+        if telemetry is not None:
+            telemetry.add_normalize_time(time.perf_counter() - normalize_start_time)
+
+        if stemming_table is not None:
+            stemming_table.update(zip(vocabulary, stems))
+
+        vocabulary = stems
+
+    try:
+        for i in range(skip_documents, number_of_documents):
+            if telemetry is not None:
+                telemetry.report_input_read(i + 1, (i + 1) / number_of_documents)
+
+            content = [vocabulary[token_id] for token_id in token_ids[doc_offsets[i]:doc_offsets[i + 1]]]
+            yield [doc_ids[i], content]
+    finally:
+        for view in (token_ids, doc_ids, doc_offsets, vocabulary_offsets, cache_view):
+            view.release()
+        cache.close()
+
+
+def peak_memory_usage():
+    """
+    Returns the peak resident set size (RSS) of this process in MiB, or None where the resource module is not
+    available (Windows). The memory of the tokenization workers is not included.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+
+
+def current_memory_usage():
+    """
+    Returns the current resident set size (RSS) of this process in MiB, or None where /proc is not available
+    (anything but Linux).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+class IndexingTelemetry:
+    """
+    Keeps track of the throughput, memory usage and time per phase of an indexing:
+        tokenize    ->  reading the input and tokenizing it (or waiting for the tokenization workers)
+        normalize   ->  stemming
+        invert      ->  adding the documents to the in-memory postings
+        write       ->  writing runs and checkpoints, merging the runs and writing the index
+    If a file path is given, a record is written to it as a JSON line every TELEMETRY_INTERVAL_DOCUMENTS documents or
+    TELEMETRY_INTERVAL_SECONDS seconds, and a summary record when the indexing is done. Without a file path only the
+    time per phase is kept, which costs a few clock reads per document.
+
+    The remaining time is estimated from the number of rows of the input (documents, also duplicates) that the
+    indexer has consumed, and the number of rows in the input, which is estimated from the share of the input that
+    the document stream has read so far (the tokenization workers read ahead of the indexer).
+    """
+    PHASES = ('tokenize', 'normalize', 'invert', 'write')
+
+    def __init__(self, file_path=None, rows_at_start=0):
+        self.file = open(file_path, 'w') if file_path else None
+        self.start_time = time.time()
+        self.phase_times = dict.fromkeys(self.PHASES, 0.0)
+
+        # rows of the input that were already indexed before this run (if it is resumed), and the number of rows
+        # and share (0 - 1) of the input that the document stream has read
+        self.rows_at_start = rows_at_start
+        self.input_rows_read = 0
+        self.input_share_read = 0.0
+
+        self.documents = 0
+        self.tokens = 0
+        self.last_record_time = self.start_time
+        self.last_record_documents = 0
+        self.last_record_tokens = 0
+
+        if self.file and TELEMETRY_TRACEMALLOC:
+            tracemalloc.start()
+
+    def report_input_read(self, rows_read, share_read):
+        self.input_rows_read = rows_read
+        self.input_share_read = share_read
+
+    def estimate_remaining_time(self, rows_consumed, elapsed_time):
+        if not self.input_share_read or rows_consumed <= self.rows_at_start:
+            return None
+
+        estimated_rows = self.input_rows_read / self.input_share_read
+        rows_per_second = (rows_consumed - self.rows_at_start) / max(elapsed_time, 1e-9)
+
+        return max(estimated_rows - rows_consumed, 0) / rows_per_second
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] += seconds
+
+    def add_normalize_time(self, seconds):
+        # the documents are normalized while the indexer waits for the next document, which is counted as tokenize
+        self.phase_times['normalize'] += seconds
+        self.phase_times['tokenize'] -= seconds
+
+    def add_document(self, number_of_tokens):
+        self.documents += 1
+        self.tokens += number_of_tokens
+
+    def is_record_due(self):
+        return self.file is not None and \
+            (self.documents - self.last_record_documents >= TELEMETRY_INTERVAL_DOCUMENTS or
+             time.time() - self.last_record_time >= TELEMETRY_INTERVAL_SECONDS)
+
+    def memory_usage(self):
+        """
+        Returns the memory part of a record, in MiB.
+        """
+        memory = {'rss_mib': current_memory_usage(), 'peak_rss_mib': peak_memory_usage()}
+
+        if tracemalloc.is_tracing():
+            memory['tracemalloc_peak_mib'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+
+        return memory
+
+    def write_record(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()  # the records should be readable while the indexing is running
+
+    def record_progress(self, rows_consumed, vocabulary_size, number_of_postings):
+        """
+        Writes a progress record, the rates are over the documents since the previous record.
+        """
+        now = time.time()
+        elapsed_time = now - self.start_time
+        interval_time = max(now - self.last_record_time, 1e-9)
+
+        eta = self.estimate_remaining_time(rows_consumed, elapsed_time)
+
+        record = {'type': 'progress', 'elapsed_s': round(elapsed_time, 3), 'documents': self.documents,
+                  'tokens': self.tokens,
+                  'docs_per_s': round((self.documents - self.last_record_documents) / interval_time, 2),
+                  'tokens_per_s': round((self.tokens - self.last_record_tokens) / interval_time, 1),
+                  'vocabulary_size': vocabulary_size, 'postings': number_of_postings,
+                  'eta_s': round(eta, 1) if eta is not None else None,
+                  'phase_s': {phase: round(seconds, 3) for phase, seconds in self.phase_times.items()}}
+        record.update(self.memory_usage())
+        self.write_record(record)
+
+        self.last_record_time = now
+        self.last_record_documents = self.documents
+        self.last_record_tokens = self.tokens
+
+    def finish(self):
+        """
+        Writes the summary record and prints the time per phase, with the phase that dominates the indexing.
+        """
+        if self.file is None:
+            return
+
+        elapsed_time = time.time() - self.start_time
+        dominant_phase = max(self.phase_times, key=self.phase_times.get)
+
+        record = {'type': 'summary', 'elapsed_s': round(elapsed_time, 3), 'documents': self.documents,
+                  'tokens': self.tokens, 'docs_per_s': round(self.documents / max(elapsed_time, 1e-9), 2),
+                  'tokens_per_s': round(self.tokens / max(elapsed_time, 1e-9), 1),
+                  'phase_s': {phase: round(seconds, 3) for phase, seconds in self.phase_times.items()},
+                  'dominant_phase': dominant_phase}
+        record.update(self.memory_usage())
+        self.write_record(record)
+        self.file.close()
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        print(f'Indexed {self.documents} documents ({self.tokens} tokens) in {elapsed_time:.1f} s')
+        for phase, seconds in self.phase_times.items():
+            print(f'    {phase:<10} {seconds:>9.2f} s {100 * seconds / max(elapsed_time, 1e-9):>6.1f}%')
+        print(f'The indexing is dominated by {dominant_phase}')
+
+
+def write_checkpoint(checkpoint, file_path=CHECKPOINT_FILEPATH):
+    """
+    Writes the state of an indexing (dict) to the checkpoint file. The state is first written to a temporary file
+    that then replaces the checkpoint, so an indexing that is killed while writing still has the previous checkpoint.
+    """
+    temporary_file_path = file_path + '.tmp'
+
+    with open(temporary_file_path, 'wb') as write_checkpoint_file:
+        pickle.dump(checkpoint, write_checkpoint_file)
+
+    os.replace(temporary_file_path, file_path)
+
+
+def append_checkpoint_arrays(arrays, array_lengths, file_path=CHECKPOINT_FILEPATH):
+    """
+    Appends the values that every array (name -> array) got since the previous checkpoint to the side file of the
+    array, so that a checkpoint only holds the lengths of the arrays (array_lengths, name -> length in the previous
+    checkpoint, which is updated). Every side file is first cut to its length in the previous checkpoint, which drops
+    the values of an indexing that was killed before it wrote its checkpoint.
+    """
+    for name, values in arrays.items():
+        with open(f'{file_path}.{name}', 'ab') as write_array_file:
+            write_array_file.truncate(array_lengths.get(name, 0) * values.itemsize)
+            values[array_lengths.get(name, 0):].tofile(write_array_file)
+
+        array_lengths[name] = len(values)
+
+
+def read_checkpoint_arrays(array_lengths, typecodes, file_path=CHECKPOINT_FILEPATH):
+    """
+    Reads the arrays (name -> length) of a checkpoint from their side files (see append_checkpoint_arrays).
+    """
+    arrays = {}
+
+    for name, length in array_lengths.items():
+        arrays[name] = array(typecodes[name])
+        with open(f'{file_path}.{name}', 'rb') as read_array_file:
+            arrays[name].fromfile(read_array_file, length)
+
+    return arrays
+
+
+def read_checkpoint(settings, file_path=CHECKPOINT_FILEPATH):
+    """
+    Reads the state of an indexing from the checkpoint file. Raises a ValueError if the checkpoint was written by an
+    indexing with other settings, since continuing it would not give the index those settings ask for.
+    """
+    with open(file_path, 'rb') as read_checkpoint_file:
+        checkpoint = pickle.load(read_checkpoint_file)
+
+    if checkpoint['settings'] != settings:
+        raise ValueError(f'The checkpoint {file_path} was written with the settings {checkpoint["settings"]}, '
+                         f'not {settings}')
+
+    return checkpoint
+
+
+def build_index(in_file, out_dict, out_postings, number_of_workers=NUMBER_OF_WORKERS,
+                biword_min_frequency=BIWORD_MIN_FREQUENCY, suffix_array=BUILD_SUFFIX_ARRAY, resume=False,
+                telemetry_file=None):
     """
     build index from documents stored in the input directory,
     then output the dictionary file and postings file
+
+    If biword_min_frequency is not None, the biwords (pairs of adjacent terms) that appear in at least this many
+    documents are also indexed, with 0 all biwords are indexed. If suffix_array is set, a suffix array over the
+    term ids of all documents is also built (see write_suffix_array).
+
+    Every CHECKPOINT_INTERVAL documents, the postings are flushed to a run and the rest of the state of the indexing
+    is written to a checkpoint. If resume is set, the indexing continues after the documents of the last
+    checkpoint, which gives the same index as an indexing that was never interrupted.
+
+    If telemetry_file is given, the progress of the indexing is written to it (see IndexingTelemetry).
     """
+    index_biwords = biword_min_frequency is not None
+
+    # a checkpoint can only be continued with the same input and settings
+    settings = (os.path.abspath(in_file) if PREPROCESS_FILE else CORPUS_CACHE_FILEPATH, index_biwords, suffix_array,
+                USE_STEMMING)
+
+    # read before anything is written, so the files of the interrupted indexing are kept if the checkpoint is wrong
+    checkpoint = read_checkpoint(settings) if resume else None
+
+    # the term ids of all indexed documents (each followed by a 0) and where every document starts, for the suffix array
+    term_stream = array('I')
+    document_starts = array('I')
 
     # Wipe all contents from the files before running the code. Because we are appending (open with 'ab')
     # dictionaries from every block, we want to start from clean files.
@@ -216,70 +957,205 @@ def build_index(in_file, out_dict, out_postings):
         open(out_dict, 'w').close()
         open(out_postings, 'w').close()
 
-    df = pre_process_file(in_file) if PREPROCESS_FILE else open_processed_file()
+    # raw token -> stem of every distinct token, filled while the documents are normalized (if stemming is used)
+    stemming_table = {}
 
     ### START OF INDEXING ###
 
-    number_of_documents = len(df)
+    # counted while streaming, every row of the csv file is counted (also the ones that are duplicates)
+    number_of_documents = 0
 
     # Dictionaries for 1-grams
     term_to_term_id = {}
     term_id_to_term = {}
     dictionary = {}
     postings_list = {}
-    documents_lengths = {}
+
+    # every indexed document is given a dense doc number (0, 1, 2, ...) in the order it is indexed, the postings and
+    # document lengths use the doc numbers instead of the sparse case ids of the csv file.
+    document_ids = array('I')  # doc number -> case id
+    documents_lengths = array('d')  # doc number -> weighted length
 
     # create unique term id's that are incremented for every NEW word we discover in the full corpus.
     term_id = 1
 
-    already_indexed_doc = []
+    already_indexed_doc = set()
 
     previous_time = time.time()
     currently_process_document_idx = 0
 
+    # file paths of the runs that have been flushed to disk, and the number of positions currently in memory
+    run_file_paths = []
+    positions_in_memory = 0
+
+    # the arrays that grow with every document are appended to side files of the checkpoint, this is the length of
+    # every array in the last checkpoint
+    checkpoint_array_lengths = {}
+
+    if checkpoint is not None:
+        number_of_documents = checkpoint['number_of_documents']  # the rows of the input that are already indexed
+        term_to_term_id = checkpoint['term_to_term_id']
+        term_id_to_term = {term_id: term for term, term_id in term_to_term_id.items()}
+        term_id = len(term_to_term_id) + 1
+        dictionary = checkpoint['dictionary']
+        checkpoint_array_lengths = checkpoint['array_lengths']
+        checkpoint_arrays = read_checkpoint_arrays(checkpoint_array_lengths, CHECKPOINT_ARRAY_TYPECODES)
+        document_ids = checkpoint_arrays['document_ids']
+        documents_lengths = checkpoint_arrays['documents_lengths']
+        term_stream = checkpoint_arrays['term_stream']
+        document_starts = checkpoint_arrays['document_starts']
+        already_indexed_doc = set(document_ids)
+        currently_process_document_idx = len(document_ids)
+        run_file_paths = checkpoint['run_file_paths']
+        stemming_table = checkpoint['stemming_table']
+
+        print(f'Resuming the indexing after {number_of_documents} documents and {len(run_file_paths)} runs')
+
+    telemetry = IndexingTelemetry(telemetry_file, number_of_documents)
+
+    # documents are streamed one at a time from the csv reader, through tokenization and normalization,
+    # and straight into the index. Hence, the full corpus is never held in memory.
+    if PREPROCESS_FILE:
+        documents = pre_process_file(in_file, number_of_workers, stemming_table, number_of_documents, telemetry)
+    else:
+        documents = open_corpus_cache(number_of_workers=number_of_workers, stemming_table=stemming_table,
+                                      skip_documents=number_of_documents, telemetry=telemetry)
+
     print(f'Creating index ...')
-    for document_id, content in df:
+    phase_start_time = time.perf_counter()
+    for document_id, content in documents:
+        invert_start_time = time.perf_counter()
+        telemetry.add_time('tokenize', invert_start_time - phase_start_time)
+        phase_start_time = invert_start_time
+
+        number_of_documents += 1
+
         if (currently_process_document_idx + 1) % 100 == 0:
             latest_time = time.time()
 
-            print(f'Currently done with {currently_process_document_idx + 1}/{number_of_documents} docs \n'
+            print(f'Currently done with {currently_process_document_idx + 1} docs \n'
                   f'These docs took: {latest_time - previous_time}')
 
             previous_time = latest_time
 
-        # dictionary that keeps track of every terms frequency in this specific document
-        # this is later converted to a sum of weighted tf^2 for use in search.py
-        document_weights = {}
-
         if document_id in already_indexed_doc:
             print('This document have already been indexed')
             continue  # skip this document by going to the next iteration in the for loop
 
-        already_indexed_doc.append(document_id)  # keep track of all document id that have been indexed already
+        already_indexed_doc.add(document_id)  # keep track of all document id that have been indexed already
+
+        document_number = len(document_ids)
+        document_ids.append(document_id)
 
-        term_id = create_positional_index(content, document_id, term_id, term_to_term_id, term_id_to_term,
-                                          dictionary, postings_list, document_weights)
+        # the frequency of every term in this specific document is converted to a sum of weighted tf^2
+        # for use in search.py
+        term_id, term_frequencies = create_positional_index(content, document_number, term_id, term_to_term_id,
+                                                            term_id_to_term, dictionary, postings_list,
+                                                            index_biwords)
 
-        calculate_document_weight(document_weights, documents_lengths, document_id)
+        documents_lengths.append(calculate_document_weight(term_frequencies))
         currently_process_document_idx += 1
 
+        if suffix_array:
+            document_starts.append(len(term_stream))
+            term_stream.extend(term_to_term_id[token] for token in content)
+            term_stream.append(0)  # term ids start at 1, so a phrase can never match across two documents
+
+        write_start_time = time.perf_counter()
+        telemetry.add_time('invert', write_start_time - invert_start_time)
+        telemetry.add_document(len(content))
+
+        positions_in_memory += 2 * len(content) if index_biwords else len(content)
+        is_checkpoint = CHECKPOINT_INTERVAL and currently_process_document_idx % CHECKPOINT_INTERVAL == 0
+
+        if positions_in_memory >= MAX_POSITIONS_IN_MEMORY or is_checkpoint:
+            # the memory budget is reached, flush the postings to a sorted run on disk and start a new run.
+            run_file_paths.append(write_run(postings_list, len(run_file_paths)))
+            print(f'Flushed run {len(run_file_paths)} with {positions_in_memory} positions to disk')
+
+            postings_list = {}
+            positions_in_memory = 0
+
+            if is_checkpoint:
+                # nothing of the indexed documents is left in memory only, so the indexing can be continued from here
+                append_checkpoint_arrays({'document_ids': document_ids, 'documents_lengths': documents_lengths,
+                                          'term_stream': term_stream, 'document_starts': document_starts},
+                                         checkpoint_array_lengths)
+                write_checkpoint({'settings': settings, 'number_of_documents': number_of_documents,
+                                  'term_to_term_id': term_to_term_id, 'dictionary': dictionary,
+                                  'run_file_paths': run_file_paths, 'stemming_table': stemming_table,
+                                  'array_lengths': checkpoint_array_lengths})
+                print(f'Wrote a checkpoint after {number_of_documents} documents')
+
+        if telemetry.is_record_due():
+            # the postings are counted from the document frequencies (which also count documents in earlier runs)
+            telemetry.record_progress(number_of_documents, len(term_to_term_id), sum(dictionary.values()))
+
+        phase_start_time = time.perf_counter()
+        telemetry.add_time('write', phase_start_time - write_start_time)
+
     """
-    dictionary      ->  term_id          : number_of_documents_term_appears_in, postings_list_position_in_file
-    postings_list   ->  [[document_id_1, terms_occurrences_in_document, <pos_1, pos_2, ...>, skip_ptr_idx]
-                         [document_id_2, terms_occurrences_in_document, <pos_1, pos_2, ...>, 0]
+    dictionary      ->  term_id          : (number_of_documents_term_appears_in, postings_list_position_in_file,
+                                            positions_block_position_in_file, positions_block_length)
+    postings_list   ->  [[document_number_1, terms_occurrences_in_document, positions_offset_1, skip_ptr_idx]
+                         [document_number_2, terms_occurrences_in_document, positions_offset_2, 0]
                          ...]
+    positions_block ->  <pos_1, pos_2, ...><pos_1, pos_2, ...>...
+
+    The postings lists (doc ids and term frequencies) and the positions are written to two separate files, so that
+    queries without phrases never read any positions. The positions of a posting are gap-encoded as varints and
+    start at positions_offset in the term's positions block, they are only decoded in search.py when a phrase
+    query actually needs them.
+
+    Biwords are stored in the same way as terms, their term (in term_conversion.txt) is a tuple of two terms.
     """
 
+    # the time to find out that there are no more documents is also spent in the document stream
+    write_start_time = time.perf_counter()
+    telemetry.add_time('tokenize', write_start_time - phase_start_time)
+
     if WRITE_INDEX_TO_FILE:
-        with open(out_postings, 'wb') as write_postings:
-            for term_id, posting_list in postings_list.items():
-                skip_list = add_skip_ptrs(posting_list, len(posting_list))
+        # the postings still in memory act as the last run, so nothing is written to disk if the budget was never hit
+        runs = [read_run(run_file_path) for run_file_path in run_file_paths]
+        runs.append((term_id, postings_list[term_id]) for term_id in sorted(postings_list))
+
+        # biwords that appear in too few documents are not written to the index
+        dropped_biword_ids = []
+        biword_bytes = 0
+
+        with open(out_postings, 'wb') as write_postings, open(POSITIONS_FILEPATH, 'wb') as write_positions:
+            for term_id, (skip_list, positions_block) in merge_runs(runs, dictionary):
+                is_biword = index_biwords and isinstance(term_id_to_term[term_id], tuple)
+
+                if is_biword and dictionary[term_id] < biword_min_frequency:
+                    dropped_biword_ids.append(term_id)
+                    continue
+
                 writer_position = write_postings.tell()
+                positions_writer_position = write_positions.tell()
 
                 pickle.dump(skip_list, write_postings)
+                write_positions.write(positions_block)
+
+                # every term_id in the dictionary will be a tuple of
+                # (doc_frequency, writer offset, positions writer offset, length of positions block)
+                dictionary[term_id] = (dictionary[term_id], writer_position, positions_writer_position,
+                                       len(positions_block))
+
+                if is_biword:
+                    biword_bytes += write_postings.tell() - writer_position + len(positions_block)
+
+            index_bytes = write_postings.tell() + write_positions.tell()
+
+        for biword_id in dropped_biword_ids:
+            del dictionary[biword_id]
+            del term_to_term_id[term_id_to_term[biword_id]]
 
-                # every term_id in the dictionary will be a tuple of (doc_frequency, writer offset)
-                dictionary[term_id] = (dictionary[term_id], writer_position)
+        if index_biwords:
+            number_of_biwords = sum(1 for term in term_to_term_id if isinstance(term, tuple))
+            print(f'Indexed {number_of_biwords} of {number_of_biwords + len(dropped_biword_ids)} biwords, they take '
+                  f'{biword_bytes} of the {index_bytes} bytes of postings and positions '
+                  f'({100 * biword_bytes / max(index_bytes - biword_bytes, 1):.1f}% overhead)')
 
         with open(out_dict, 'wb') as write_dict:
             pickle.dump(dictionary, write_dict)
@@ -288,36 +1164,82 @@ def build_index(in_file, out_dict, out_postings):
             pickle.dump(number_of_documents, write_lengths)
             pickle.dump(documents_lengths, write_lengths)  # store LENGTH[N] for future normalization
 
+        with open(DOCUMENT_IDS_FILEPATH, 'wb') as write_document_ids:
+            # doc number -> case id, the doc numbers are only translated back to case ids in the search results
+            pickle.dump(document_ids, write_document_ids)
+
         with open(TERM_CONVERSION_FILEPATH, 'wb') as write_term_converter:
             # term (str) -> term id (int, 4 bytes)
             pickle.dump(term_to_term_id, write_term_converter)
             pickle.dump(term_to_term_id, write_term_converter)
 
+        if USE_STEMMING:
+            write_stemming_table(stemming_table)
 
-def usage():
-    print("usage: " + sys.argv[0] + " -i csv-of-documents -d dictionary-file -p postings-file")
+    for run_file_path in run_file_paths:
+        os.remove(run_file_path)
 
+    # the indexing is done, there is nothing left to resume
+    for checkpoint_file_path in [CHECKPOINT_FILEPATH] + [f'{CHECKPOINT_FILEPATH}.{name}'
+                                                         for name in CHECKPOINT_ARRAY_TYPECODES]:
+        if os.path.exists(checkpoint_file_path):
+            os.remove(checkpoint_file_path)
 
-input_csv = output_file_dictionary = output_file_postings = None
+    if suffix_array and WRITE_INDEX_TO_FILE:
+        write_suffix_array(term_stream, document_starts, document_ids)
 
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
+    telemetry.add_time('write', time.perf_counter() - write_start_time)
+    telemetry.finish()
 
-for o, a in opts:
-    if o == '-i':  # input directory
-        input_csv = a
-    elif o == '-d':  # dictionary file
-        output_file_dictionary = a
-    elif o == '-p':  # postings file
-        output_file_postings = a
-    else:
-        assert False, "unhandled option"
+    peak_memory = peak_memory_usage()
+    if peak_memory is not None:
+        print(f'Peak memory usage (RSS) of the indexer: {peak_memory:.0f} MiB')
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -i csv-of-documents -d dictionary-file -p postings-file "
+                                    "[-w number-of-tokenization-workers] [-b biword-min-document-frequency] [-s] "
+                                    "[-t telemetry-file] [--resume]")
+
+
+if __name__ == '__main__':
+    # the worker processes import this file, they should not start an indexing of their own
+    input_csv = output_file_dictionary = output_file_postings = None
+    workers = NUMBER_OF_WORKERS
+    biword_min_df = BIWORD_MIN_FREQUENCY
+    with_suffix_array = BUILD_SUFFIX_ARRAY
+    resume_from_checkpoint = False
+    output_file_telemetry = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:w:b:st:', ['resume'])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i':  # input directory
+            input_csv = a
+        elif o == '-d':  # dictionary file
+            output_file_dictionary = a
+        elif o == '-p':  # postings file
+            output_file_postings = a
+        elif o == '-w':  # number of tokenization worker processes
+            workers = int(a)
+        elif o == '-b':  # index biwords that appear in at least this many documents
+            biword_min_df = int(a)
+        elif o == '-s':  # also build a suffix array for phrase search
+            with_suffix_array = True
+        elif o == '-t':  # write telemetry records (JSON lines) of the indexing to this file
+            output_file_telemetry = a
+        elif o == '--resume':  # continue an interrupted indexing from its last checkpoint
+            resume_from_checkpoint = True
+        else:
+            assert False, "unhandled option"
 
-if input_csv is None or output_file_postings is None or output_file_dictionary is None:
-    usage()
-    sys.exit(2)
+    if input_csv is None or output_file_postings is None or output_file_dictionary is None:
+        usage()
+        sys.exit(2)
 
-build_index(input_csv, output_file_dictionary, output_file_postings)
+    build_index(input_csv, output_file_dictionary, output_file_postings, workers, biword_min_df, with_suffix_array,
+                resume_from_checkpoint, output_file_telemetry)
@@ -1,18 +1,43 @@
 #!/usr/bin/python3
 import math
+import mmap
 import pickle
 import re
+import struct
 import nltk
 import sys
 import getopt
+import json
+import os
+import time
+from bisect import bisect_right
+from contextlib import contextmanager, nullcontext
 from heapq import heappop, heappush, heapify
 
 PORTER_STEMMER = nltk.stem.porter.PorterStemmer()
 
 DOCUMENT_LENGTHS_FILEPATH = 'document_lengths.txt'
+DOCUMENT_IDS_FILEPATH = 'document_ids.txt'
 TERM_CONVERSION_FILEPATH = 'term_conversion.txt'
+POSITIONS_FILEPATH = 'positions.txt'
 USE_STEMMING = False
 USE_THESAURUS_QE = False
+USE_BIWORD_INDEX = True  # use the biwords of the index (if it has any, see index.py -b) to evaluate phrases
+USE_SUFFIX_ARRAY = False  # evaluate exact phrases with the suffix array (see index.py -s) instead, can be set with -s
+WRITE_SCORES = False  # write the score of every result after its doc id, can be set with --scores
+
+THESAURUS_FILEPATH = 'thesaurus.txt'  # written by build_thesaurus.py
+STEMMING_TABLE_FILEPATH = 'stemming_table.txt'  # written by index.py if stemming is used
+SUFFIX_ARRAY_FILEPATH = 'suffix_array.bin'
+SUFFIX_ARRAY_MAGIC = b'HW4SUFX1'
+SUFFIX_ARRAY_HEADER = struct.Struct('<8s3Q')
+
+suffix_array_index = None  # the SuffixArray, it is loaded the first time a phrase is searched with it
+thesaurus = None  # the thesaurus of the query expansion, it is loaded the first time a query is expanded
+stemming_table = None  # raw token -> stem of the indexed vocabulary, it is loaded the first time a token is stemmed
+tracer = None  # the QueryTracer if the queries are traced (-t), else None
+
+NO_TRACE_SPAN = nullcontext()
 
 class TrackScore:
     def __init__(self, doc_id, score):
@@ -20,8 +45,9 @@ class TrackScore:
         self.score = score
 
     def __str__(self):
-        # can uncomment the last lines for debugging of the scores.
-        return str(self.document_id) #+ " (" + str(self.score) + ")"
+        if WRITE_SCORES:
+            return str(self.document_id) + " (" + str(self.score) + ")"
+        return str(self.document_id)
 
     def __lt__(self, other):
         """
@@ -41,47 +67,302 @@ class TrackScore:
         return str(self.score)
 
 
+class QueryTracer:
+    """
+    Traces where the time of every query goes. The time of a query is split into the phases:
+        parse, dictionary, postings_io, unpickle, phrase (HW4 only), scoring, heap, write
+    where the time of a phase does not include the time of the phases (spans) nested in it, e.g. the postings that
+    are read while scoring count as postings_io and unpickle, not as scoring. The bytes read and the number of
+    postings decoded are also recorded for every term. Every query is written as a JSON line to the trace file.
+    The HW3 and HW4 search.py have identical copies of this class, so that every HW stays self-contained.
+    """
+    def __init__(self, file_path, dictionary, term_to_term_id, postings_file_path):
+        self.file = open(file_path, 'w')
+        self.latencies = []
+
+        self.term_id_to_term = {term_id: ' '.join(term) if isinstance(term, tuple) else term
+                                for term, term_id in term_to_term_id.items()}
+
+        # the length of every pickled posting list, such that reading and unpickling it can be timed separately
+        offsets = sorted(entry[1] for entry in dictionary.values()) + [os.path.getsize(postings_file_path)]
+        next_offsets = dict(zip(offsets, offsets[1:]))
+        self.postings_lengths = {term_id: next_offsets[entry[1]] - entry[1] for term_id, entry in dictionary.items()}
+
+    def start_query(self, query):
+        self.query = query.strip()
+        self.phase_times = {}
+        self.terms = {}
+        self.open_spans = []
+        self.query_start_time = time.perf_counter()
+
+    @contextmanager
+    def span(self, phase):
+        start_time = time.perf_counter()
+
+        if self.open_spans:
+            # the enclosing span is paused while this span is open
+            enclosing_phase, enclosing_start_time = self.open_spans[-1]
+            self.add_time(enclosing_phase, start_time - enclosing_start_time)
+
+        self.open_spans.append([phase, start_time])
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            _, span_start_time = self.open_spans.pop()
+            self.add_time(phase, end_time - span_start_time)
+
+            if self.open_spans:
+                self.open_spans[-1][1] = end_time
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] = self.phase_times.get(phase, 0) + seconds
+
+    def record_term(self, term_id, bytes_read, postings_decoded):
+        term = self.term_id_to_term[term_id]
+        if term not in self.terms:
+            self.terms[term] = {'bytes_read': 0, 'postings_decoded': 0}
+
+        self.terms[term]['bytes_read'] += bytes_read
+        self.terms[term]['postings_decoded'] += postings_decoded
+
+    def end_query(self):
+        latency = time.perf_counter() - self.query_start_time
+        self.latencies.append(latency)
+
+        self.file.write(json.dumps({'query': self.query, 'latency_ms': round(1000 * latency, 3),
+                                    'phases_ms': {phase: round(1000 * seconds, 3)
+                                                  for phase, seconds in self.phase_times.items()},
+                                    'terms': self.terms}) + '\n')
+
+    def finish(self):
+        """
+        Closes the trace file and prints the latency percentiles of the queries.
+        """
+        self.file.close()
+
+        if not self.latencies:
+            return
+
+        latencies = sorted(self.latencies)
+        percentiles = {p: latencies[min(len(latencies) - 1, math.ceil(p / 100 * len(latencies)) - 1)]
+                       for p in (50, 95, 99)}
+
+        print(f'Latency of {len(latencies)} queries: ' +
+              ', '.join(f'p{p} {1000 * latency:.2f} ms' for p, latency in percentiles.items()))
+
+
+def trace_span(phase):
+    """
+    Returns the span of a phase of the query that is being traced, or a span that does nothing if tracing is off.
+    """
+    return tracer.span(phase) if tracer is not None else NO_TRACE_SPAN
+
+
+class SuffixArray:
+    """
+    The suffix array written by index.py (see write_suffix_array), memory-mapped such that only the parts that are
+    visited by the binary searches are read from disk.
+    """
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as read_suffix_array:
+            self.file = mmap.mmap(read_suffix_array.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, number_of_terms, number_of_documents, self.depth = SUFFIX_ARRAY_HEADER.unpack_from(self.file)
+        if magic != SUFFIX_ARRAY_MAGIC:
+            raise ValueError(f'{file_path} is not a suffix array')
+
+        # every section is an array of uint32, they are read directly from the memory-mapped file. The documents are
+        # in order of doc number, so the case ids (the last section) are not needed.
+        sections = memoryview(self.file)[SUFFIX_ARRAY_HEADER.size:].cast('I')
+        self.term_stream = sections[:number_of_terms]
+        self.suffix_array = sections[number_of_terms:2 * number_of_terms]
+        self.document_starts = sections[2 * number_of_terms:2 * number_of_terms + number_of_documents]
+
+    def suffix_prefix(self, suffix_array_idx, length):
+        """
+        Returns the first length term ids (list) of the suffix at an index in the suffix array.
+        """
+        start = self.suffix_array[suffix_array_idx]
+        return self.term_stream[start:start + length].tolist()
+
+    def find_range(self, phrase_term_ids):
+        """
+        Binary searches the suffix array for the range [low, high) of suffixes that start with the phrase.
+        Time Complexity: O(|phrase| * log(n))
+        """
+        low, high = 0, len(self.suffix_array)
+        while low < high:
+            middle = (low + high) // 2
+            if self.suffix_prefix(middle, len(phrase_term_ids)) < phrase_term_ids:
+                low = middle + 1
+            else:
+                high = middle
+
+        range_start, high = low, len(self.suffix_array)
+        while low < high:
+            middle = (low + high) // 2
+            if self.suffix_prefix(middle, len(phrase_term_ids)) <= phrase_term_ids:
+                low = middle + 1
+            else:
+                high = middle
+
+        return range_start, low
+
+    def find_phrase(self, phrase_term_ids):
+        """
+        Finds all occurrences of a phrase (list of term ids). The suffixes are only sorted on their first depth
+        terms, so for a longer phrase the rest of the phrase is compared for every suffix that starts the same.
+        Returns a posting list on the form [doc_number, phrase_frequency, <phrase start positions>, 0].
+        """
+        range_start, range_end = self.find_range(phrase_term_ids[:self.depth])
+
+        # document number (order in the index) -> start positions of the phrase in the document
+        document_positions = {}
+
+        for start in self.suffix_array[range_start:range_end]:
+            if len(phrase_term_ids) > self.depth and \
+                    self.term_stream[start:start + len(phrase_term_ids)].tolist() != phrase_term_ids:
+                continue
+
+            document_number = bisect_right(self.document_starts, start) - 1
+            position = start - self.document_starts[document_number] + 1  # positions start at 1 in the index
+
+            if document_number not in document_positions:
+                document_positions[document_number] = []
+            document_positions[document_number].append(position)
+
+        result_posting = []
+        for document_number in sorted(document_positions):
+            positions = sorted(document_positions[document_number])
+            result_posting.append([document_number, len(positions), encode_positions(positions), 0])
+
+        return result_posting
+
+
+def load_suffix_array():
+    """
+    Loads the suffix array the first time it is needed, and returns it.
+    """
+    global suffix_array_index
+
+    if suffix_array_index is None:
+        suffix_array_index = SuffixArray(SUFFIX_ARRAY_FILEPATH)
+
+    return suffix_array_index
+
+
+def load_stemming_table():
+    """
+    Loads the stemming table written by index.py the first time it is needed, and returns it.
+    """
+    global stemming_table
+
+    if stemming_table is None:
+        with open(STEMMING_TABLE_FILEPATH, 'rb') as read_stemming_table:
+            stemming_table = pickle.load(read_stemming_table)
+
+    return stemming_table
+
+
 def normalize_token(token):
     """
     Case-folds and porter-stems a token (str word). Returns a normalized token (str word).
+    The stems of the indexed vocabulary are looked up in the stemming table, only other tokens are stemmed.
     """
     token = token.lower()  # case folding
 
-    # currently not using any stemming due to the time complexity of this operation
     if USE_STEMMING:
-        token = PORTER_STEMMER.stem(token)  # porter-stemming
+        stems = load_stemming_table()
+        token = stems[token] if token in stems else PORTER_STEMMER.stem(token)  # porter-stemming
 
     return token
 
 
+def encode_positions(positions):
+    """
+    Gap-encodes a sorted list of positions and writes every gap as a varint (7 bits per byte, the high bit is set
+    on every byte except the last one of a gap). Returns the encoded positions (bytes). Same encoding as in index.py.
+    """
+    encoded_positions = bytearray()
+    previous_position = 0
+
+    for position in positions:
+        gap = position - previous_position
+        previous_position = position
+
+        while gap >= 0x80:
+            encoded_positions.append((gap & 0x7F) | 0x80)
+            gap >>= 7
+        encoded_positions.append(gap)
+
+    return bytes(encoded_positions)
+
+
+def decode_positions(encoded_positions):
+    """
+    Decodes varint, gap-encoded positions (bytes) back to a sorted list of positions. The positions in a posting are
+    only decoded when they are needed, i.e. when a phrase query is evaluated.
+    """
+    positions = []
+    position = 0
+    gap = 0
+    shift = 0
+
+    for byte in encoded_positions:
+        gap |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            position += gap
+            positions.append(position)
+            gap = 0
+            shift = 0
+
+    return positions
+
+
+def load_thesaurus():
+    """
+    Loads the thesaurus precomputed by build_thesaurus.py the first time it is needed, and returns
+    (signature token -> token id, term -> list of (signature, synonyms) for every sense of the term).
+    """
+    global thesaurus
+
+    if thesaurus is None:
+        with open(THESAURUS_FILEPATH, 'rb') as read_thesaurus:
+            signature_token_to_id = pickle.load(read_thesaurus)
+            thesaurus = (signature_token_to_id, pickle.load(read_thesaurus))
+
+    return thesaurus
+
+
 def lesk_algorithm_simple(query, word):
     """
     Implementation from pseudo-code found in: https://www.youtube.com/watch?v=wxZwML6Gs3o&ab_channel=NatalieParde
+    The senses of the word (from WordNet) are looked up in the thesaurus that is precomputed by build_thesaurus.py.
     """
-    all_senses = nltk.corpus.wordnet.synsets(word)
+    signature_token_to_id, senses_of_terms = load_thesaurus()
+
+    all_senses = senses_of_terms.get(word.lower())
 
     if not all_senses:
         return None
 
-    best_sense = all_senses[0]
-    max_overlap = 0
-
-    for sense in all_senses:
-        signature = set(nltk.tokenize.word_tokenize(sense.definition()))
+    query_token_ids = {signature_token_to_id[token] for token in query if token in signature_token_to_id}
 
-        for example in sense.examples():
-            signature.union(nltk.tokenize.word_tokenize(example))
+    _, best_synonyms = all_senses[0]
+    max_overlap = 0
 
-        overlap = signature.intersection(set(query))
+    for signature, synonyms in all_senses:
+        overlap = query_token_ids.intersection(signature)
 
         if len(overlap) > max_overlap:
             max_overlap = len(overlap)
-            best_sense = sense
-
-    synonym_choices = [lemma.name() for lemma in best_sense.lemmas()]
+            best_synonyms = synonyms
 
-    for synonym in synonym_choices:
-        if synonym.isalpha() and synonym != word:
+    for synonym in best_synonyms:
+        if synonym != word:
             # return the first match that is alphanumeric (i.e. not a word that includes spaces)
             # and that is not the word we are searching a synonym for.
             return synonym
@@ -117,22 +398,71 @@ def retrieve_postings_list(dictionary, term_id):
     """
     Takes a term id and retrieves its posting list by using the dictionary to find the offset
     in the file the posting list was written to. Returns said postings list.
+    Every posting is [doc_id, term_freq, positions_offset, skip_ptr_idx], no positions are read.
     """
+    if tracer is not None:
+        return retrieve_traced_postings_list(dictionary, term_id)
+
     with open(postings_file, 'rb') as read_postings:
         reader_offset = dictionary[term_id][1]
         read_postings.seek(reader_offset)
         return pickle.load(read_postings)
 
 
-def search_term(term_to_search, dictionary, term_to_term_id):
+def retrieve_traced_postings_list(dictionary, term_id):
+    """
+    retrieve_postings_list when tracing, the posting list is first read and then unpickled, so both can be timed.
+    """
+    with tracer.span('postings_io'):
+        with open(postings_file, 'rb') as read_postings:
+            read_postings.seek(dictionary[term_id][1])
+            pickled_posting_list = read_postings.read(tracer.postings_lengths[term_id])
+
+    with tracer.span('unpickle'):
+        posting_list = pickle.loads(pickled_posting_list)
+
+    tracer.record_term(term_id, len(pickled_posting_list), len(posting_list))
+    return posting_list
+
+
+def retrieve_positional_postings_list(dictionary, term_id):
+    """
+    Retrieves a term's posting list together with its positions, which are read from the positions file.
+    Every posting is [doc_id, term_freq, <encoded positions>, skip_ptr_idx], see decode_positions.
+    """
+    posting_list = retrieve_postings_list(dictionary, term_id)
+
+    with trace_span('postings_io'):
+        with open(POSITIONS_FILEPATH, 'rb') as read_positions:
+            read_positions.seek(dictionary[term_id][2])
+            positions_block = read_positions.read(dictionary[term_id][3])
+
+    if tracer is not None:
+        tracer.record_term(term_id, len(positions_block), 0)
+
+    # the positions of a posting ends where the positions of the next posting starts
+    positions_ends = [posting[2] for posting in posting_list[1:]] + [len(positions_block)]
+    for posting, positions_end in zip(posting_list, positions_ends):
+        posting[2] = positions_block[posting[2]:positions_end]
+
+    return posting_list
+
+
+def search_term(term_to_search, dictionary, term_to_term_id, with_positions=False):
     """
     Converts a term (str) to a posting list. Tries to first convert the term (str) to a term id (int) and
-    then uses this term id to call a function that retrieves the posting list.
+    then uses this term id to call a function that retrieves the posting list. The positions are only read
+    if with_positions is set, i.e. when a phrase is being evaluated.
     """
-    if term_to_search not in term_to_term_id:
-        return []  # if the query term does not exist in dictionary, return an empty posting list
+    with trace_span('dictionary'):
+        if term_to_search not in term_to_term_id:
+            return []  # if the query term does not exist in dictionary, return an empty posting list
+
+        term_id = term_to_term_id[term_to_search]
+
+    if with_positions:
+        return retrieve_positional_postings_list(dictionary, term_id)
 
-    term_id = term_to_term_id[term_to_search]
     return retrieve_postings_list(dictionary, term_id)
 
 
@@ -157,6 +487,9 @@ def calculate_idf(number_of_docs, document_frequency):
 
 
 def cosine_normalize_factor(weight_squared_sum):
+    if weight_squared_sum == 0:
+        # e.g. a query where every term is in every document (idf 0), all of its scores are 0 anyway
+        return 0
     return 1 / math.sqrt(weight_squared_sum)
 
 
@@ -211,182 +544,317 @@ def merge_boolean_query(a, b, save_both_docs=False):
     return resulting_postings
 
 
-def handle_phrase_query(phrase_search_term_joined, dictionary, term_to_term_id):
+def parse_query(query):
+    """
+    Splits a query (str) into its terms. A quoted phrase of more than one word, optionally followed by a proximity
+    operator, becomes a phrase term: a tuple of the normalized words of the phrase and the proximity k (None for an
+    exact phrase), e.g. '"fiduciary duty"/3 AND breach' -> [(('fiduciary', 'duty'), 3), 'AND', 'breach'].
+    The words of a phrase are taken as they are, so a word of a phrase may contain a / (e.g. "section 1/2").
+    Returns the terms and whether the query is a boolean query.
+    """
+    # the text outside of quotes, then for every quoted phrase: its text, its proximity operator (or None), its text
+    # after it and so on. E.g. '"fiduciary duty"/3 AND breach' -> ['', 'fiduciary duty', '/3', ' AND breach']
+    query_parts = re.split(r'\"(.+?)\"(/\d+)?', query)
+
+    query_terms = query_parts[0].split()
+    for idx in range(1, len(query_parts), 3):
+        words = [normalize_token(word) for word in query_parts[idx].split()]
+        proximity = query_parts[idx + 1]
+
+        if len(words) > 1:
+            query_terms.append((tuple(words), int(proximity[1:]) if proximity else None))
+        else:
+            query_terms += words  # a quoted word is searched as a term
+
+        query_terms += query_parts[idx + 2].split()
+
+    # we know that the query should be treated as a boolean query if it includes quotes or the "AND" operator.
+    is_boolean_query = len(query_parts) > 1 or 'AND' in query_terms
+
+    return query_terms, is_boolean_query
+
+
+def handle_phrase_query(phrase, dictionary, term_to_term_id):
     """
-    Driver function for converting a %-joined phrase term on the form "hi%my%name" into a resulting posting
-    list containing all the documents where this phrase was written (the 2 or 3 words happened in order).
+    Driver function for converting a phrase term (words, proximity) on the form (('hi', 'my', 'name'), None) into a
+    resulting posting list containing all the documents where this phrase was written (the words happened in order).
+    A phrase of any length is supported. With a proximity on the form (('hi', 'my', 'name'), 3), every word of the
+    phrase should instead be within 3 words (before or after) of the previous word in the phrase.
+
+    If the index has biwords, a phrase of two words is answered directly by its biword, and the biwords of a
+    longer phrase are used to filter out documents before the positions are intersected.
+    With USE_SUFFIX_ARRAY, exact phrases are instead found by binary searching the suffix array.
     """
-    postings = []
-    term_frequencies = []
+    terms, proximity = phrase
+
+    if proximity is None and USE_SUFFIX_ARRAY:
+        if not all(term in term_to_term_id for term in terms):
+            return []
+
+        return load_suffix_array().find_phrase([term_to_term_id[term] for term in terms])
+
+    # the posting lists of the biwords (adjacent words) in the phrase that are in the index
+    biword_postings = []
+
+    if proximity is None and USE_BIWORD_INDEX:
+        biwords = [(terms[i], terms[i + 1]) for i in range(len(terms) - 1)]
+
+        if len(terms) == 2 and biwords[0] in term_to_term_id:
+            # the postings of the biword are the postings of the phrase, no positions have to be read.
+            # Every posting is [document_id, phrase_frequency, positions_offset, skip_ptr].
+            return search_term(biwords[0], dictionary, term_to_term_id)
+
+        for biword in set(biwords):
+            if biword in term_to_term_id:
+                biword_postings.append(search_term(biword, dictionary, term_to_term_id))
+
+        if biword_postings and not intersect_postings(biword_postings):
+            return []  # no document contains all biwords of the phrase, no positions have to be read
+
+    postings = {}
+    term_frequencies = {}
+
+    for term in terms:
+        if term in postings:
+            continue  # a word can appear several times in a phrase, its posting list is only retrieved once
 
-    for term in phrase_search_term_joined.split('%'):
         dictionary_term = search_dictionary(term, dictionary, term_to_term_id)
-        posting_term = search_term(term, dictionary, term_to_term_id)
+        posting_term = search_term(term, dictionary, term_to_term_id, with_positions=True)
 
         if not dictionary_term or not posting_term:
             return []
 
-        postings.append(posting_term)
-        term_frequencies.append(dictionary_term[0])
+        postings[term] = posting_term
+        term_frequencies[term] = dictionary_term[0]
 
-    sorted_postings_list = [x for _, x in sorted(zip(term_frequencies, postings))]
+    if proximity is None:
+        return phrase_intersection([postings[term] for term in terms],
+                                   [term_frequencies[term] for term in terms], biword_postings)
 
-    result = []
+    return proximity_intersection([postings[term] for term in terms], proximity)
 
-    if len(sorted_postings_list) == 2:
-        result = phrase_intersection(sorted_postings_list[0], sorted_postings_list[1])
-    elif len(sorted_postings_list) == 3:
-        intermediate_intersection = phrase_intersection(sorted_postings_list[0], sorted_postings_list[1])
-        result = phrase_intersection(intermediate_intersection, sorted_postings_list[2])
-    else:
-        print(f'Invalid length of phrase.')
 
-    return result
+def advance_to_document(posting_list, idx, document_id):
+    """
+    Moves forward in a posting list from idx until the first posting with a document id >= document_id.
+    Skip pointers are used whenever they do not skip past the document. Returns the new index.
+    """
+    posting_list_length = len(posting_list)
+
+    while idx < posting_list_length and posting_list[idx][0] < document_id:
+        skip_idx = posting_list[idx][3]
+
+        if skip_idx != 0 and posting_list[skip_idx][0] <= document_id:
+            idx = skip_idx  # use skip pointer
+        else:
+            idx += 1
+
+    return idx
 
 
-def phrase_intersection(p_1, p_2):
+def intersect_postings(posting_lists):
     """
-    Proximity intersection of posting lists p1 and p2 where the two words appear at the
-    correct distance (distance == 1 for phrase query) from each other.
+    n-ary intersection of posting lists. The lists are traversed in order of increasing length (i.e. document
+    frequency), such that every document in the shortest list is looked for in the next shortest list and so on.
+    Returns a list of (document_id, [the document's posting in every list, in the same order as posting_lists]).
+    Time Complexity: O(x + y + ...), but usually much less since skip pointers are used in all but the shortest list.
     """
-    merged_postings = merge_boolean_query(p_1, p_2, True)
+    if not posting_lists or not all(posting_lists):
+        return []
 
-    result_posting = []
+    rarest_first = sorted(range(len(posting_lists)), key=lambda list_idx: len(posting_lists[list_idx]))
+    indices = [0] * len(posting_lists)
 
-    i = 0
-    while i < len(merged_postings):
-        # creates a new posting list that mimics the form of a term's posting list
-        # [document_id, phrase_frequency, phrase_position, skip_ptr (None / 0)]
-        document_temp_list = [merged_postings[i][0], 0, [], 0]
-        this_doc_is_relevant = False
+    result = []
 
-        for position_x in merged_postings[i][2]:
-            for position_y in merged_postings[i + 1][2]:
-                if position_x == position_y - 1:
-                    document_temp_list[1] += 1  # add one to the term frequency
-                    document_temp_list[2].append(position_y)
-                    this_doc_is_relevant = True
+    for posting in posting_lists[rarest_first[0]]:
+        document_id = posting[0]
+        is_match = True
 
-        if this_doc_is_relevant:
-            result_posting.append(document_temp_list)
+        for list_idx in rarest_first[1:]:
+            indices[list_idx] = advance_to_document(posting_lists[list_idx], indices[list_idx], document_id)
 
-        i += 2  # want to increment i by two every iteration.
+            if indices[list_idx] == len(posting_lists[list_idx]):
+                return result  # one of the lists is exhausted, there can not be any more matches
 
-    return result_posting
+            if posting_lists[list_idx][indices[list_idx]][0] != document_id:
+                is_match = False
+                break
 
+        if is_match:
+            result.append((document_id, [posting_list[indices[list_idx]] if list_idx != rarest_first[0] else posting
+                                         for list_idx, posting_list in enumerate(posting_lists)]))
 
-def write_results_to_file(results_file, heap, number_of_results=None):
+    return result
+
+
+def intersect_positions(start_positions, positions, offset):
     """
-    Takes a file path and a heap of (TrackScore) objects and writes them in order of decreasing score to the file.
+    Linear merge of two sorted lists of positions. Returns the phrase start positions s in start_positions where
+    s + offset is in positions, i.e. where the word with the given offset in the phrase is in its correct place.
+    Time Complexity: O(x + y)
     """
-    if number_of_results:
-        # only write the top X results, or less if there isn't 10 good matches.
-        number_of_results = number_of_results if len(heap) > number_of_results else len(heap)
-    else:
-        number_of_results = len(heap)
+    result = []
 
-    out_string = " ".join([str(heappop(heap)) for _ in range(number_of_results)]) + '\n'
+    start_idx = 0
+    positions_idx = 0
+    number_of_starts = len(start_positions)
+    number_of_positions = len(positions)
 
-    with open(results_file, 'a') as write_result:
-        write_result.write(out_string)
+    while start_idx < number_of_starts and positions_idx < number_of_positions:
+        shifted_position = positions[positions_idx] - offset
+
+        if start_positions[start_idx] == shifted_position:
+            result.append(shifted_position)
+            start_idx += 1
+            positions_idx += 1
+        elif start_positions[start_idx] < shifted_position:
+            start_idx += 1
+        else:
+            positions_idx += 1
+
+    return result
 
 
-def add_term_freq_to_dictionary(posting_list, dictionary, initial_creation=False):
+def positions_within_distance(previous_positions, positions, distance):
     """
-    Adds the term/phrase frequency in a document to a dictionary for use when ranking boolean queries.
-    output: dictionary -> doc_id_1: [3, 13], doc_id_2: [11, 12]. Which would mean that in doc_id_1, the first term
-    appeared 3 times and the second term or phrase 13 times in the document.
+    Linear merge of two sorted lists of positions. Returns the positions p in positions where some position
+    in previous_positions is at most distance words before or after p.
+    Time Complexity: O(x + y)
     """
+    result = []
 
-    for posting in posting_list:
-        term_freq_in_doc = len(posting[2])
-        if posting[0] not in dictionary and initial_creation:
-            dictionary[posting[0]] = [term_freq_in_doc]
-        elif posting[0] in dictionary and not initial_creation:
-            dictionary[posting[0]].append(term_freq_in_doc)
+    previous_idx = 0
+    number_of_previous_positions = len(previous_positions)
 
-    return dictionary
+    for position in positions:
+        # move to the first previous position that is not too far before this position
+        while previous_idx < number_of_previous_positions and previous_positions[previous_idx] < position - distance:
+            previous_idx += 1
 
+        if previous_idx == number_of_previous_positions:
+            break
 
-def filter_term_freq(dictionary, results):
+        nearest_idx = previous_idx
+        if previous_positions[nearest_idx] == position:
+            # a word can not be near itself (when the same word appears twice in a phrase), look at the next one
+            nearest_idx += 1
+
+        if nearest_idx < number_of_previous_positions and previous_positions[nearest_idx] <= position + distance:
+            result.append(position)
+
+    return result
+
+
+def phrase_intersection(phrase_postings, document_frequencies, filter_postings=()):
     """
-    Updates the document term frequency dictionary to only include the documents that are still matching
-    the boolean query and keeping track of the most frequent yet.
+    Positional intersection of the posting lists of all words in a phrase (in the order they are in the phrase).
+    Documents are intersected first, then for every document the positions of the words are intersected in order
+    of increasing document frequency (rarest first). Every position is shifted by the word's offset in the phrase,
+    so a document matches when some start position remains after all words have been intersected.
+    The filter postings (e.g. of the biwords in the phrase) are only used in the intersection of the documents.
+    Returns a posting list on the form [document_id, phrase_frequency, <phrase start positions>, 0].
+    Time Complexity: linear in the number of postings and positions of the words.
     """
-    new_dict = {}
-    global_max_freq = 1
-    for result in results:
-        new_dict[result[0]] = dictionary[result[0]]
+    rarest_first = sorted(range(len(phrase_postings)), key=lambda offset: document_frequencies[offset])
 
-        max_freq = max(dictionary[result[0]])
-        if max_freq > global_max_freq:
-            global_max_freq = max_freq
+    result_posting = []
+
+    for document_id, postings in intersect_postings(list(phrase_postings) + list(filter_postings)):
+        rarest_offset = rarest_first[0]
+        # the positions are only decoded here, for the documents that contain all words
+        start_positions = [position - rarest_offset for position in decode_positions(postings[rarest_offset][2])]
 
-    del dictionary
+        for offset in rarest_first[1:]:
+            start_positions = intersect_positions(start_positions, decode_positions(postings[offset][2]), offset)
 
-    new_dict['highest_occ'] = global_max_freq
-    return new_dict
+            if not start_positions:
+                break
 
+        if start_positions:
+            # creates a new posting that mimics the form of a term's posting (positions encoded in the same way)
+            result_posting.append([document_id, len(start_positions), encode_positions(start_positions), 0])
+
+    return result_posting
 
-def handle_boolean_query(query, dictionary, term_to_term_id, boolean_query=False, merged_posting_list=None, document_term_freq=None):
+
+def proximity_intersection(phrase_postings, proximity):
     """
-    Gets called if the query is a boolean query. Takes a list of query terms, and is the driver function for calling
-    functions that process phrases, retrieve posting lists and merge posting lists. It is called recursively until
-    all of the query have been processed.
+    Proximity intersection of the posting lists of all words in a phrase (in the order they are in the phrase),
+    where every word should be at most proximity words before or after the previous word.
+    Returns a posting list on the form [document_id, frequency, <positions of the last word>, 0].
+    Time Complexity: linear in the number of postings and positions of the words.
     """
-    if document_term_freq is None:
-        document_term_freq = {}
+    result_posting = []
 
-    if merged_posting_list is None:
-        merged_posting_list = []
+    for document_id, postings in intersect_postings(phrase_postings):
+        matching_positions = decode_positions(postings[0][2])
 
-    if 'AND' in query or boolean_query:
-        first_AND_idx = query.index('AND')  # raises ValueError if not found.
+        for posting in postings[1:]:
+            matching_positions = positions_within_distance(matching_positions, decode_positions(posting[2]),
+                                                           proximity)
 
-        if len(query) < 2:
-            # error in the input. just return the results this far / or an empty list as it won't break anything.
-            print(f'Error in the input.')
-            return merged_posting_list
+            if not matching_positions:
+                break
 
-        right_search_term = query[first_AND_idx + 1]
+        if matching_positions:
+            result_posting.append([document_id, len(matching_positions), encode_positions(matching_positions), 0])
 
-        if not merged_posting_list:
-            # in case this is the very first query term/phrase in this query.
+    return result_posting
 
-            left_search_term = query[first_AND_idx - 1]
 
-            query.pop(0)  # remove the left search term from the query
+def write_results_to_file(results_file, heap, number_of_results=None):
+    """
+    Takes a file path and a heap of (TrackScore) objects and writes them in order of decreasing score to the file.
+    """
+    if number_of_results:
+        # only write the top X results, or less if there isn't 10 good matches.
+        number_of_results = number_of_results if len(heap) > number_of_results else len(heap)
+    else:
+        number_of_results = len(heap)
 
-            if '%' in left_search_term:
-                merged_posting_list = handle_phrase_query(left_search_term, dictionary, term_to_term_id)
-            else:
-                merged_posting_list = search_term(left_search_term, dictionary, term_to_term_id)
+    out_string = " ".join([str(heappop(heap)) for _ in range(number_of_results)]) + '\n'
 
-            add_term_freq_to_dictionary(merged_posting_list, document_term_freq, True)
+    with open(results_file, 'a') as write_result:
+        write_result.write(out_string)
 
-        if '%' in right_search_term:
-            right_posting_list = handle_phrase_query(right_search_term, dictionary, term_to_term_id)
-        else:
-            right_posting_list = search_term(right_search_term, dictionary, term_to_term_id)
 
-        add_term_freq_to_dictionary(right_posting_list, document_term_freq)
+def handle_boolean_query(query, dictionary, term_to_term_id):
+    """
+    Gets called if the query is a boolean query. Takes a list of query terms, retrieves the posting list of every
+    term/phrase that is separated by AND and intersects all of them at once, starting with the one of the lowest
+    document frequency (see intersect_postings).
+    Returns the postings (of the first term/phrase) of the matching documents, and a dictionary with the term/phrase
+    frequencies in every matching document for use when ranking boolean queries:
+    doc_id_1: [3, 13], doc_id_2: [11, 12], 'highest_occ': 13. Which would mean that in doc_id_1, the first term
+    appeared 3 times and the second term or phrase 13 times in the document.
+    """
+    if 'AND' not in query:
+        print(f'Error in input.')
+        return []
 
-        query.pop(0)  # remove the 'AND' term from the query
-        query.pop(0)  # remove the right search term from the query
+    search_terms = [term for term in query if term != 'AND']
 
-        result_postings = merge_boolean_query(merged_posting_list, right_posting_list)
+    posting_lists = []
+    for search_term_or_phrase in search_terms:
+        if isinstance(search_term_or_phrase, tuple):
+            posting_lists.append(handle_phrase_query(search_term_or_phrase, dictionary, term_to_term_id))
+        else:
+            posting_lists.append(search_term(search_term_or_phrase, dictionary, term_to_term_id))
 
-        document_term_freq = filter_term_freq(document_term_freq, result_postings)
+    result_postings = []
+    document_term_freq = {}
+    global_max_freq = 1
 
-        # if we still have not gone through all of the query, we recur.
-        if query:
-            return handle_boolean_query(query, dictionary, term_to_term_id, True, result_postings, document_term_freq)
-        else:
-            return result_postings, document_term_freq
+    for document_id, postings in intersect_postings(posting_lists):
+        result_postings.append(postings[0])
 
-    else:
-        print(f'Error in input.')
-        return []
+        term_frequencies = [posting[1] for posting in postings]
+        document_term_freq[document_id] = term_frequencies
+        global_max_freq = max(global_max_freq, max(term_frequencies))
+
+    document_term_freq['highest_occ'] = global_max_freq
+    return result_postings, document_term_freq
 
 
 def boolean_and_freq_to_score(frequency_vector, priority_constant=6):
@@ -431,13 +899,12 @@ def ranked_retrieval(query, dictionary, term_to_term_id, number_of_docs, is_bool
     sum_weight_q = 0
 
     for term in query:
-        is_phrase_query = False
-
-        if '%' in term:
-            is_phrase_query = True
+        is_phrase_query = isinstance(term, tuple)
 
         if is_phrase_query:  # in case of phrase query
-            posting_t = handle_phrase_query(term, dictionary, term_to_term_id)
+            with trace_span('phrase'):
+                posting_t = handle_phrase_query(term, dictionary, term_to_term_id)
+
             if posting_t:
                 doc_freq = len(posting_t)
                 idf_qt = calculate_idf(number_of_docs, doc_freq)
@@ -446,9 +913,10 @@ def ranked_retrieval(query, dictionary, term_to_term_id, number_of_docs, is_bool
                 idf_qt = 0
 
         else:  # in case of a single search term
-            if term in term_to_term_id:
-                term_id = term_to_term_id[term]
-                doc_freq = dictionary[term_id][0]
+            with trace_span('dictionary'):
+                doc_freq = dictionary[term_to_term_id[term]][0] if term in term_to_term_id else None
+
+            if doc_freq is not None:
 
                 # idf query -> parameters: total number of documents and document frequency
                 idf_qt = calculate_idf(number_of_docs, doc_freq)
@@ -492,11 +960,14 @@ def ranked_retrieval(query, dictionary, term_to_term_id, number_of_docs, is_bool
     return scores_pre_normalize, sum_weight_q
 
 
-def run_search(dict_file, postings_file, queries_file, results_file):
+def run_search(dict_file, postings_file, queries_file, results_file, trace_file=None):
     """
     using the given dictionary file and postings file,
     perform searching on the given queries file and output the results to a file
+
+    If trace_file is given, every query is traced (see QueryTracer) and the traces are written to this file.
     """
+    global tracer
 
     print('running search on the queries...')
 
@@ -505,7 +976,7 @@ def run_search(dict_file, postings_file, queries_file, results_file):
 
     with open(dict_file, 'rb') as read_dict:
         # We are able to read the full dictionary into memory
-        # The dictionary is structured as * term_id : (doc_freq, file_offset)
+        # The dictionary is structured as * term_id : (doc_freq, file_offset, positions_offset, positions_length)
         dictionary = pickle.load(read_dict)
 
     with open(TERM_CONVERSION_FILEPATH, 'rb') as read_term_converter:
@@ -514,33 +985,35 @@ def run_search(dict_file, postings_file, queries_file, results_file):
 
     with open(DOCUMENT_LENGTHS_FILEPATH, 'rb') as read_lengths:
         number_of_docs = pickle.load(read_lengths)
-        documents_lengths = pickle.load(read_lengths)
+        documents_lengths = pickle.load(read_lengths)  # doc number -> weighted length
+
+    with open(DOCUMENT_IDS_FILEPATH, 'rb') as read_document_ids:
+        # the postings use dense doc numbers, they are translated back to the case ids (doc number -> case id)
+        # when the results are written.
+        document_ids = pickle.load(read_document_ids)
 
     with open(queries_file, 'r') as queries:
         all_queries = queries.readlines()
 
-    for q in all_queries:
+    if trace_file is not None:
+        tracer = QueryTracer(trace_file, dictionary, term_to_term_id, postings_file)
 
-        matches = re.findall(r'\"(.+?)\"', q)  # match text between two quotes
-        for m in matches:
-            match = []
-            for word in m.split():
-                match.append(normalize_token(word))
-
-            # in case of a phrase query; concatenate the words in the phrase with a % between them.
-            q = q.replace('\"%s\"' % m, '%s' % "%".join(match))
-
-        q_split = q.split()
+    for q in all_queries:
+        if tracer is not None:
+            tracer.start_query(q)
 
-        # we know that the query should be treated as a boolean query if it includes quotes or the "AND" operator.
-        is_boolean_query = len(matches) != 0 or 'AND' in q_split
+        with trace_span('parse'):
+            # text between two quotes is a phrase, optionally followed by a proximity operator, e.g. "fiduciary duty"/3
+            q_split, is_boolean_query = parse_query(q)
 
-        if not is_boolean_query and USE_THESAURUS_QE:
-            # thesaurus-based query expansion does not seem to improve scores (actually makes it worse) so we do not use it
-            q_split = expand_query(q_split)
+            if not is_boolean_query and USE_THESAURUS_QE:
+                # thesaurus-based query expansion does not seem to improve scores (actually makes it worse) so we do
+                # not use it
+                q_split = expand_query(q_split)
 
-        for idx, term in enumerate(q_split):
-            q_split[idx] = normalize_token(term) if term != 'AND' else 'AND'
+            for idx, term in enumerate(q_split):
+                # the words of a phrase have already been normalized
+                q_split[idx] = normalize_token(term) if term != 'AND' and not isinstance(term, tuple) else term
 
         print(q_split)
 
@@ -563,55 +1036,74 @@ def run_search(dict_file, postings_file, queries_file, results_file):
                 heappush(results_heap, new_score)
         """
 
-        scores_pre_normalize, sum_weight_q = ranked_retrieval(q_split, dictionary, term_to_term_id,
-                                                                number_of_docs, is_boolean_query)
+        with trace_span('scoring'):
+            scores_pre_normalize, sum_weight_q = ranked_retrieval(q_split, dictionary, term_to_term_id,
+                                                                    number_of_docs, is_boolean_query)
 
-        for key, value in scores_pre_normalize.items():
-            # note: the document lengths was calculated during indexing and is used from a dictionary during search.
+        with trace_span('heap'):
+            for key, value in scores_pre_normalize.items():
+                # note: the document lengths was calculated during indexing and is used from a dictionary during search.
+
+                normalized_score = value * cosine_normalize_factor(sum_weight_q) * \
+                                   cosine_normalize_factor(documents_lengths[key])
+
+                # TrackScore is a custom class that is used to be able to define our own definition of "<" and "="
+                # between objects and also the string representation of such objects.
+                new_score = TrackScore(document_ids[key], normalized_score)
 
-            normalized_score = value * cosine_normalize_factor(sum_weight_q) * \
-                               cosine_normalize_factor(documents_lengths[key])
+                # this max-heap have the score of ALL documents, uses the heapq (min-heap) module but turns into a
+                # max-heap by changing the definitions of lt and eq with TrackScore class.
+                heappush(results_heap, new_score)
 
-            # TrackScore is a custom class that is used to be able to define our own definition of "<" and "="
-            # between objects and also the string representation of such objects.
-            new_score = TrackScore(key, normalized_score)
+        with trace_span('write'):
+            write_results_to_file(results_file, results_heap)
 
-            # this max-heap have the score of ALL documents, uses the heapq (min-heap) module but turns into a
-            # max-heap by changing the definitions of lt and eq with TrackScore class.
-            heappush(results_heap, new_score)
+        if tracer is not None:
+            tracer.end_query()
 
-        write_results_to_file(results_file, results_heap)
+    if tracer is not None:
+        tracer.finish()
+        tracer = None
 
 
 ### Handle input ###
 
 def usage():
-    print("usage: " +
-          sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
-
-
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
-
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-
-for o, a in opts:
-    if o == '-d':
-        dictionary_file = a
-    elif o == '-p':
-        postings_file = a
-    elif o == '-q':
-        file_of_queries = a
-    elif o == '-o':
-        file_of_output = a
-    else:
-        assert False, "unhandled option"
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries " +
+          "-o output-file-of-results [-s] [-t trace-file] [--scores]")
+
+
+if __name__ == '__main__':
+    # the search functions can be imported (e.g. by benchmark_phrase.py) without running a search
+    dictionary_file = postings_file = file_of_queries = file_of_output = None
+    file_of_trace = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:st:', ['scores'])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            file_of_queries = a
+        elif o == '-o':
+            file_of_output = a
+        elif o == '-s':  # search phrases with the suffix array
+            USE_SUFFIX_ARRAY = True
+        elif o == '-t':  # trace every query
+            file_of_trace = a
+        elif o == '--scores':  # e.g. to compare the scores with benchmarks/golden_results.py
+            WRITE_SCORES = True
+        else:
+            assert False, "unhandled option"
 
-if dictionary_file is None or postings_file is None or file_of_queries is None or file_of_output is None:
-    usage()
-    sys.exit(2)
+    if dictionary_file is None or postings_file is None or file_of_queries is None or file_of_output is None:
+        usage()
+        sys.exit(2)
 
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
+    run_search(dictionary_file, postings_file, file_of_queries, file_of_output, file_of_trace)
@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+import unittest
+
+from search import parse_query
+
+"""
+Tests of the query parsing of search.py, run with: python3 -m unittest test_search
+"""
+
+
+class TestParseQuery(unittest.TestCase):
+    def test_free_text_query(self):
+        self.assertEqual(parse_query('court appeal damages'), (['court', 'appeal', 'damages'], False))
+
+    def test_phrase_and_proximity(self):
+        self.assertEqual(parse_query('"fiduciary duty"/3 AND "breach of contract"'),
+                         ([(('fiduciary', 'duty'), 3), 'AND', (('breach', 'of', 'contract'), None)], True))
+
+    def test_slash_inside_phrase(self):
+        # a / inside the quotes is part of a word, not a proximity operator
+        self.assertEqual(parse_query('"section 1/2"'), ([(('section', '1/2'), None)], True))
+        self.assertEqual(parse_query('"and/or damages" AND court'),
+                         ([(('and/or', 'damages'), None), 'AND', 'court'], True))
+        self.assertEqual(parse_query('"section 1/2"/3'), ([(('section', '1/2'), 3)], True))
+
+    def test_quoted_word_is_a_term(self):
+        self.assertEqual(parse_query('"contract"/2 damages'), (['contract', 'damages'], True))
+
+
+if __name__ == '__main__':
+    unittest.main()
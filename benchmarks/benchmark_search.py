@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+import csv
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import getopt
+import tempfile
+import time
+
+"""
+Benchmarks the search engines of HW2 (boolean), HW3 (free text) and HW4 (phrases, boolean and free text) on the same
+corpora. For every corpus, the index of every engine is built in a temporary directory with the index.py of the engine,
+after which the query sets of the engine (benchmarks/queries) are searched with its search.py:
+    cold: every query is searched by a new process, the latency is the wall time of the process (start up, loading
+          the dictionary and reading the postings from disk for the first time)
+    warm: the query set is searched WARM_REPETITIONS times by one process, the latencies (as measured by the engine,
+          with the --explain plans of HW2 and the -t traces of HW3/HW4) of the first repetition are not counted
+The throughput follows from the warm latencies, and the peak memory (RSS) of the search and index processes is
+recorded. Every query set is measured in a number of trials, and the best value of every metric is kept, which makes
+the results less sensitive to other load on the machine. The results are compared with the baseline of the machine,
+a GATED_METRICS that is more than the threshold worse than in the baseline is a regression and the benchmark exits
+with status 1. The tail latencies and indexing time are only reported. The latencies depend on the machine, so the
+baseline is not part of the repository: the first run on a machine writes its baseline and is not compared.
+"""
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(BENCHMARKS_DIRECTORY)
+QUERIES_DIRECTORY = os.path.join(BENCHMARKS_DIRECTORY, 'queries')
+BASELINE_FILEPATH = os.path.join(BENCHMARKS_DIRECTORY, 'baseline.json')
+NLTK_DATA_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, 'HW2', 'nltk_data')
+REUTERS_DIRECTORY = os.path.join(NLTK_DATA_DIRECTORY, 'corpora', 'reuters', 'training')
+
+CORPORA = ['synthetic', 'sample']
+SAMPLE_DOCUMENTS = 2000  # the sample corpus is made of the first documents (by doc id) of the Reuters training corpus
+SYNTHETIC_DOCUMENTS = 2000
+SYNTHETIC_DOCUMENT_LENGTH = (50, 400)  # the number of words of a synthetic document is drawn between these bounds
+SYNTHETIC_PHRASE_PROBABILITY = 0.02  # the probability that one of SYNTHETIC_PHRASES is written instead of a word
+SYNTHETIC_SEED = 3245
+
+# the words of the synthetic corpus, from the most to the least frequent (the frequency of a word is 1 / rank)
+SYNTHETIC_VOCABULARY = """
+the of to and in a said for on is that it by with from at as be was mln pct will has year its billion dlrs company
+would not are which an have market new bank trade oil price prices share shares government last two also stock rate
+rates sales profit tax first could one about up exchange week foreign offer agreement years loss interest official
+expected growth net quarter dollar debt since industry told production export import because corp group month court
+contract plaintiff held duty appeal damages law judge evidence gas japan board product record crude output economy
+budget deficit report tonnes wheat grain sugar coffee gold plan union spokesman president minister policy demand
+supply shipping futures loan credit capital income dividend acquisition merger bid management earnings revenue
+""".split()
+SYNTHETIC_PHRASES = ['breach of contract', 'the court held that', 'oil prices', 'interest rates', 'said the company',
+                     'of the', 'in the']
+
+ENGINES = ['hw2', 'hw3', 'hw4']
+ENGINE_DIRECTORIES = {'hw2': 'HW2', 'hw3': 'HW3', 'hw4': 'HW4'}
+QUERY_SETS = {
+    'hw2': ['boolean'],
+    'hw3': ['free_text'],
+    'hw4': ['phrase', 'boolean', 'free_text', 'common_words'],
+}
+
+WARM_REPETITIONS = 5
+TRIALS = 3
+REGRESSION_THRESHOLD = 0.3  # a metric that is more than 30% worse than in the baseline is a regression
+GATED_METRICS = {'cold_p50_ms', 'warm_p50_ms', 'throughput_qps', 'search_peak_mib', 'index_peak_mib'}
+HIGHER_IS_BETTER = {'throughput_qps'}
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (nearest rank) of a non-empty list of values.
+    """
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, -(-p * len(values) // 100) - 1))]
+
+
+def write_synthetic_corpus(documents_directory):
+    """
+    Writes SYNTHETIC_DOCUMENTS documents (files 1, 2, ...) with words drawn from a Zipf distribution over
+    SYNTHETIC_VOCABULARY, where some of SYNTHETIC_PHRASES are mixed in. The corpus is the same on every run.
+    """
+    generator = random.Random(SYNTHETIC_SEED)
+    cumulative_weights = []
+    total_weight = 0
+    for rank in range(1, len(SYNTHETIC_VOCABULARY) + 1):
+        total_weight += 1 / rank
+        cumulative_weights.append(total_weight)
+
+    for doc_id in range(1, SYNTHETIC_DOCUMENTS + 1):
+        length = generator.randint(*SYNTHETIC_DOCUMENT_LENGTH)
+        words = generator.choices(SYNTHETIC_VOCABULARY, cum_weights=cumulative_weights, k=length)
+
+        for i in range(length):
+            if generator.random() < SYNTHETIC_PHRASE_PROBABILITY:
+                words[i] = generator.choice(SYNTHETIC_PHRASES)
+
+        with open(os.path.join(documents_directory, str(doc_id)), 'w') as write_document:
+            write_document.write(' '.join(words) + '\n')
+
+
+def write_sample_corpus(documents_directory):
+    """
+    Copies the first SAMPLE_DOCUMENTS documents of the Reuters training corpus.
+    """
+    doc_ids = sorted(int(f) for f in os.listdir(REUTERS_DIRECTORY))[:SAMPLE_DOCUMENTS]
+    for doc_id in doc_ids:
+        shutil.copy(os.path.join(REUTERS_DIRECTORY, str(doc_id)), documents_directory)
+
+
+def write_corpus_csv(documents_directory, csv_file_path):
+    """
+    Writes the documents as the csv file that HW4 indexes (document_id, title, content, date_posted, court).
+    """
+    with open(csv_file_path, 'w', newline='') as write_csv:
+        csvwriter = csv.writer(write_csv, quoting=csv.QUOTE_ALL)
+        csvwriter.writerow(['document_id', 'title', 'content', 'date_posted', 'court'])
+
+        for doc_id in sorted(int(f) for f in os.listdir(documents_directory)):
+            with open(os.path.join(documents_directory, str(doc_id)), 'r') as read_document:
+                content = read_document.read()
+            csvwriter.writerow([doc_id, content.split('\n', 1)[0], content, '', ''])
+
+
+def run_process(arguments, working_directory):
+    """
+    Runs a python script with its arguments in working_directory and waits for it to finish.
+    Returns the wall time in seconds, the peak memory (RSS) in MiB and the output of the process.
+    """
+    environment = dict(os.environ)
+    environment['NLTK_DATA'] = os.pathsep.join(filter(None, [environment.get('NLTK_DATA'), NLTK_DATA_DIRECTORY]))
+
+    start_time = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + arguments, cwd=working_directory, env=environment,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    output = process.stdout.read()
+    process.stdout.close()
+
+    # wait4 (instead of process.wait) gives the resource usage of this process only, ru_maxrss is in KiB on Linux
+    _, status, resource_usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start_time
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    if process.returncode != 0:
+        raise RuntimeError(f'{" ".join(arguments)} failed in {working_directory}:\n{output[-2000:]}')
+
+    return seconds, resource_usage.ru_maxrss / 1024, output
+
+
+def search(engine, engine_directory, queries_file):
+    """
+    Searches the queries of queries_file with the search.py of the engine in a single process.
+    Returns the wall time in seconds, the peak memory (RSS) in MiB and the latency in ms of every query, as measured
+    by the engine itself.
+    """
+    arguments = ['search.py', '-d', 'dictionary.txt', '-p', 'postings.txt', '-q', queries_file, '-o', 'results.txt']
+
+    if engine == 'hw2':
+        seconds, peak_memory, output = run_process(arguments + ['--explain'], engine_directory)
+        latencies = [float(line.split()[1]) for line in output.splitlines() if line.startswith('total: ')]
+    else:
+        seconds, peak_memory, _ = run_process(arguments + ['-t', 'trace.jsonl'], engine_directory)
+        with open(os.path.join(engine_directory, 'trace.jsonl'), 'r') as read_trace:
+            latencies = [json.loads(line)['latency_ms'] for line in read_trace]
+
+    return seconds, peak_memory, latencies
+
+
+def benchmark_query_set(engine, engine_directory, queries, trials):
+    """
+    Returns the cold and warm latencies, the throughput and the peak memory of searching the queries (list of str),
+    the best value of every metric over the trials.
+    """
+    trial_results = [benchmark_query_set_once(engine, engine_directory, queries) for _ in range(trials)]
+
+    return {metric: (max if metric in HIGHER_IS_BETTER else min)(results[metric] for results in trial_results)
+            for metric in trial_results[0]}
+
+
+def benchmark_query_set_once(engine, engine_directory, queries):
+    """
+    Returns the cold and warm latencies, the throughput and the peak memory of searching the queries (list of str).
+    """
+    single_query_file = os.path.join(engine_directory, 'single_query.txt')
+    cold_latencies = []
+    peak_memory = 0
+
+    for query in queries:
+        with open(single_query_file, 'w') as write_queries:
+            write_queries.write(query + '\n')
+
+        seconds, process_peak_memory, _ = search(engine, engine_directory, single_query_file)
+        cold_latencies.append(1000 * seconds)
+        peak_memory = max(peak_memory, process_peak_memory)
+
+    repeated_queries_file = os.path.join(engine_directory, 'repeated_queries.txt')
+    with open(repeated_queries_file, 'w') as write_queries:
+        write_queries.write('\n'.join(queries * WARM_REPETITIONS) + '\n')
+
+    _, process_peak_memory, latencies = search(engine, engine_directory, repeated_queries_file)
+    warm_latencies = latencies[len(queries):]
+    peak_memory = max(peak_memory, process_peak_memory)
+
+    return {
+        'cold_p50_ms': percentile(cold_latencies, 50),
+        'cold_p95_ms': percentile(cold_latencies, 95),
+        'warm_p50_ms': percentile(warm_latencies, 50),
+        'warm_p95_ms': percentile(warm_latencies, 95),
+        'warm_p99_ms': percentile(warm_latencies, 99),
+        'throughput_qps': len(warm_latencies) / (sum(warm_latencies) / 1000),
+        'search_peak_mib': peak_memory,
+    }
+
+
+def benchmark_corpus(corpus, engines, work_directory, trials):
+    """
+    Builds the index of every engine over the corpus and benchmarks the query sets of the engine.
+    Returns benchmark name (corpus/engine/query set) -> metrics.
+    """
+    documents_directory = os.path.join(work_directory, 'documents')
+    os.mkdir(documents_directory)
+
+    if corpus == 'synthetic':
+        write_synthetic_corpus(documents_directory)
+    else:
+        write_sample_corpus(documents_directory)
+
+    csv_file_path = os.path.join(work_directory, 'documents.csv')
+    write_corpus_csv(documents_directory, csv_file_path)
+
+    results = {}
+    for engine in engines:
+        engine_directory = os.path.join(work_directory, engine)
+        os.mkdir(engine_directory)
+
+        for file_name in os.listdir(os.path.join(REPOSITORY_DIRECTORY, ENGINE_DIRECTORIES[engine])):
+            if file_name.endswith('.py'):
+                shutil.copy(os.path.join(REPOSITORY_DIRECTORY, ENGINE_DIRECTORIES[engine], file_name), engine_directory)
+
+        corpus_input = csv_file_path if engine == 'hw4' else documents_directory
+        index_seconds, index_peak_memory, _ = run_process(['index.py', '-i', corpus_input, '-d', 'dictionary.txt',
+                                                           '-p', 'postings.txt'], engine_directory)
+        results[f'{corpus}/{engine}/index'] = {'index_seconds': index_seconds, 'index_peak_mib': index_peak_memory}
+        print(f'Indexed the {corpus} corpus with {engine} in {index_seconds:.1f} s')
+
+        for query_set in QUERY_SETS[engine]:
+            with open(os.path.join(QUERIES_DIRECTORY, f'{engine}_{query_set}.txt'), 'r') as read_queries:
+                queries = [line.strip() for line in read_queries if line.strip()]
+
+            results[f'{corpus}/{engine}/{query_set}'] = benchmark_query_set(engine, engine_directory, queries, trials)
+
+    return results
+
+
+def print_results(results):
+    metrics = ['index_seconds', 'index_peak_mib', 'cold_p50_ms', 'cold_p95_ms', 'warm_p50_ms', 'warm_p95_ms',
+               'warm_p99_ms', 'throughput_qps', 'search_peak_mib']
+
+    print(f'\n{"benchmark":<30}' + ''.join(f'{metric:>16}' for metric in metrics))
+    for name, values in results.items():
+        print(f'{name:<30}' + ''.join(f'{values[metric]:>16.2f}' if metric in values else f'{"-":>16}'
+                                      for metric in metrics))
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    Prints every metric that changed by more than the threshold compared to the baseline.
+    Returns the number of regressions (GATED_METRICS that got worse by more than the threshold).
+    """
+    regressions = 0
+    print(f'\nCompared with the baseline (threshold {threshold:.0%}):')
+
+    for name, values in results.items():
+        if name not in baseline:
+            print(f'{name:<30} not in the baseline')
+            continue
+
+        for metric, value in values.items():
+            baseline_value = baseline[name].get(metric)
+            if not baseline_value:
+                continue
+
+            change = value / baseline_value - 1
+            worse = -change if metric in HIGHER_IS_BETTER else change
+
+            if abs(change) > threshold:
+                is_regression = worse > threshold and metric in GATED_METRICS
+                regressions += is_regression
+                print(f'{name:<30} {metric:<16} {baseline_value:>10.2f} -> {value:>10.2f} ({change:+.0%})' +
+                      (' REGRESSION' if is_regression else ' improvement' if worse < 0 else ''))
+
+    print(f'{regressions} regression(s)')
+    return regressions
+
+
+def run_benchmark(corpora, engines, trials, baseline_file, update_baseline, threshold):
+    results = {}
+    for corpus in corpora:
+        with tempfile.TemporaryDirectory() as work_directory:
+            results.update(benchmark_corpus(corpus, engines, work_directory, trials))
+
+    print_results(results)
+
+    if update_baseline or not os.path.exists(baseline_file):
+        # the first run on a machine (or -u) writes the baseline that the later runs are compared with
+        with open(baseline_file, 'w') as write_baseline:
+            json.dump({name: {metric: round(value, 3) for metric, value in values.items()}
+                       for name, values in results.items()}, write_baseline, indent=2, sort_keys=True)
+        print(f'\nWrote the baseline to {baseline_file}, the next runs on this machine are compared with it')
+        return 0
+
+    with open(baseline_file, 'r') as read_baseline:
+        baseline = json.load(read_baseline)
+
+    return 1 if compare_with_baseline(results, baseline, threshold) else 0
+
+
+def usage():
+    print("usage: " + sys.argv[0] +
+          " [-c corpus] [-e engine] [-n trials] [-b baseline-file] [-r regression-threshold] [-u]")
+
+
+if __name__ == '__main__':
+    selected_corpora = CORPORA
+    selected_engines = ENGINES
+    number_of_trials = TRIALS
+    baseline_filepath = BASELINE_FILEPATH
+    regression_threshold = REGRESSION_THRESHOLD
+    write_baseline = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'c:e:n:b:r:u')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-c':  # synthetic, sample, or both separated by a comma
+            selected_corpora = a.split(',')
+        elif o == '-e':  # hw2, hw3, hw4, or several separated by commas
+            selected_engines = a.split(',')
+        elif o == '-n':
+            number_of_trials = int(a)
+        elif o == '-b':
+            baseline_filepath = a
+        elif o == '-r':
+            regression_threshold = float(a)
+        elif o == '-u':  # write the results as the new baseline instead of comparing with it
+            write_baseline = True
+        else:
+            assert False, "unhandled option"
+
+    if not set(selected_corpora) <= set(CORPORA) or not set(selected_engines) <= set(ENGINES):
+        usage()
+        sys.exit(2)
+
+    sys.exit(run_benchmark(selected_corpora, selected_engines, number_of_trials, baseline_filepath, write_baseline,
+                           regression_threshold))
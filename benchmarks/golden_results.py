@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+import os
+import re
+import shlex
+import subprocess
+import sys
+import getopt
+import tempfile
+
+"""
+Checks that an engine (or a mode of it, e.g. HW4 search.py -s) still returns the same results as the reference, so
+that a performance change can not silently change the results. The reference is either a results file (e.g. the
+HW2/search_results.txt and HW3/search_results.txt that come with the repo) or the output of the engine without any
+extra arguments. Both are run on the same index and queries, in the directory of the engine (where its index is).
+
+The results of every query (line) are compared:
+    boolean: the two results must be the same set of doc ids
+    ranked:  the doc ids must be in the same order, where two documents may swap ranks if they are at most
+             RANK_TOLERANCE ranks apart. If both results have scores (HW3/HW4 search.py --scores), the score at every
+             rank must be within SCORE_TOLERANCE of the reference, and documents with (almost) the same score may be in
+             any order
+The first divergence is reported together with its query.
+"""
+
+MODES = ['boolean', 'ranked']
+RANK_TOLERANCE = 0
+SCORE_TOLERANCE = 1e-9
+RESULT_PATTERN = re.compile(r'(\d+)(?: \(([^)]*)\))?')  # a doc id, optionally followed by its score, e.g. 246 (0.12)
+
+
+def read_results(results_file):
+    """
+    Returns the results of every query (line) in the results file, as a list of (doc id, score) where score is None
+    if the results file has no scores.
+    """
+    with open(results_file, 'r') as read_results_file:
+        return [[(int(doc_id), float(score) if score else None) for doc_id, score in RESULT_PATTERN.findall(line)]
+                for line in read_results_file]
+
+
+def compare_boolean(reference, candidate):
+    """
+    Returns a description of how the candidate results of a boolean query differ from the reference, or None if the
+    two are the same set of doc ids.
+    """
+    reference_doc_ids = {doc_id for doc_id, _ in reference}
+    candidate_doc_ids = {doc_id for doc_id, _ in candidate}
+
+    if reference_doc_ids == candidate_doc_ids:
+        return None
+
+    missing = sorted(reference_doc_ids - candidate_doc_ids)
+    extra = sorted(candidate_doc_ids - reference_doc_ids)
+    return (f'{len(reference_doc_ids)} documents expected, {len(candidate_doc_ids)} returned. '
+            f'Missing: {missing[:10]}{" ..." if len(missing) > 10 else ""}, '
+            f'extra: {extra[:10]}{" ..." if len(extra) > 10 else ""}')
+
+
+def compare_ranked(reference, candidate, rank_tolerance, score_tolerance):
+    """
+    Returns a description of the first rank where the candidate results of a ranked query differ from the reference,
+    or None if they are the same (within the tolerances).
+    """
+    if len(reference) != len(candidate):
+        return f'{len(reference)} documents expected, {len(candidate)} returned'
+
+    has_scores = all(score is not None for _, score in reference + candidate)
+    reference_scores = dict(reference)
+    reference_ranks = {doc_id: rank for rank, (doc_id, _) in enumerate(reference)}
+    lowest_reference_score = reference[-1][1] if reference else None
+
+    for rank, ((expected_doc_id, expected_score), (doc_id, score)) in enumerate(zip(reference, candidate), 1):
+        if has_scores:
+            if abs(score - expected_score) > score_tolerance:
+                return (f'rank {rank}: expected {expected_doc_id} with score {expected_score}, '
+                        f'got {doc_id} with score {score}')
+
+            if doc_id in reference_scores:
+                is_same = abs(reference_scores[doc_id] - score) <= score_tolerance
+            else:
+                # a document that ties with the last reference result may have been cut off from the reference
+                is_same = abs(lowest_reference_score - score) <= score_tolerance
+
+            if not is_same:
+                return (f'rank {rank}: got {doc_id} with score {score}, which was '
+                        + (f'{reference_scores[doc_id]} in the reference' if doc_id in reference_scores
+                           else 'not in the reference'))
+
+        elif doc_id != expected_doc_id:
+            if doc_id not in reference_ranks:
+                return f'rank {rank}: expected {expected_doc_id}, got {doc_id} (not in the reference)'
+
+            if abs(reference_ranks[doc_id] - (rank - 1)) > rank_tolerance:
+                return (f'rank {rank}: expected {expected_doc_id}, got {doc_id} '
+                        f'(rank {reference_ranks[doc_id] + 1} in the reference)')
+
+    return None
+
+
+def compare_results(queries, reference_results, candidate_results, mode, rank_tolerance, score_tolerance):
+    """
+    Compares the results of every query. Returns a list of (query number, query, divergence) for every query whose
+    results diverge.
+    """
+    divergences = []
+
+    for query_number, query in enumerate(queries, 1):
+        reference = reference_results[query_number - 1] if query_number <= len(reference_results) else None
+        candidate = candidate_results[query_number - 1] if query_number <= len(candidate_results) else None
+
+        if reference is None or candidate is None:
+            divergence = f'there is no result line in the {"reference" if reference is None else "candidate"}'
+        elif mode == 'boolean':
+            divergence = compare_boolean(reference, candidate)
+        else:
+            divergence = compare_ranked(reference, candidate, rank_tolerance, score_tolerance)
+
+        if divergence is not None:
+            divergences.append((query_number, query.strip(), divergence))
+
+    return divergences
+
+
+def run_engine(engine_directory, queries_file, results_file, arguments):
+    """
+    Searches the queries with the search.py in engine_directory (with its index), with the extra arguments.
+    """
+    command = [sys.executable, 'search.py', '-d', 'dictionary.txt', '-p', 'postings.txt', '-q',
+               os.path.abspath(queries_file), '-o', os.path.abspath(results_file)] + arguments
+
+    completed = subprocess.run(command, cwd=engine_directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f'{" ".join(command)} failed:\n{completed.stdout[-2000:]}')
+
+
+def run_golden_results(queries_file, engine_directory, mode, golden_file, reference_arguments, candidate_arguments,
+                       rank_tolerance, score_tolerance):
+    with open(queries_file, 'r') as read_queries:
+        queries = read_queries.readlines()
+
+    with tempfile.TemporaryDirectory() as results_directory:
+        if golden_file is None:
+            golden_file = os.path.join(results_directory, 'reference.txt')
+            run_engine(engine_directory, queries_file, golden_file,
+                       reference_arguments + (['--scores'] if mode == 'ranked' else []))
+
+        reference_results = read_results(golden_file)
+
+        # the scores are compared too if the reference has them
+        if mode == 'ranked' and any(score is not None for results in reference_results for _, score in results):
+            candidate_arguments = candidate_arguments + ['--scores']
+
+        candidate_file = os.path.join(results_directory, 'candidate.txt')
+        run_engine(engine_directory, queries_file, candidate_file, candidate_arguments)
+        candidate_results = read_results(candidate_file)
+
+    divergences = compare_results(queries, reference_results, candidate_results, mode, rank_tolerance,
+                                  score_tolerance)
+
+    print(f'{len(queries) - len(divergences)} of {len(queries)} queries have the same results '
+          f'({mode}, candidate: search.py {" ".join(candidate_arguments)})')
+
+    if divergences:
+        query_number, query, divergence = divergences[0]
+        print(f'First divergence, query {query_number}: {query}\n    {divergence}')
+        print(f'Diverging queries: {", ".join(str(number) for number, _, _ in divergences)}')
+        return 1
+
+    return 0
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -q file-of-queries -e engine-directory [-m boolean|ranked] " +
+          "[-g golden-results-file] [-b \"reference arguments\"] [-a \"candidate arguments\"] " +
+          "[-r rank-tolerance] [-s score-tolerance]")
+
+
+if __name__ == '__main__':
+    file_of_queries = directory_of_engine = file_of_golden_results = None
+    comparison_mode = 'ranked'
+    arguments_of_reference = []
+    arguments_of_candidate = []
+    tolerance_of_ranks = RANK_TOLERANCE
+    tolerance_of_scores = SCORE_TOLERANCE
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'q:e:m:g:b:a:r:s:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-q':
+            file_of_queries = a
+        elif o == '-e':  # the directory with the search.py and index of the engine, e.g. HW2
+            directory_of_engine = a
+        elif o == '-m':
+            comparison_mode = a
+        elif o == '-g':  # compare with this results file instead of running the reference
+            file_of_golden_results = a
+        elif o == '-b':  # the extra arguments of the reference run, e.g. -b "-s"
+            arguments_of_reference = shlex.split(a)
+        elif o == '-a':  # the extra arguments of the candidate run
+            arguments_of_candidate = shlex.split(a)
+        elif o == '-r':
+            tolerance_of_ranks = int(a)
+        elif o == '-s':
+            tolerance_of_scores = float(a)
+        else:
+            assert False, "unhandled option"
+
+    if file_of_queries is None or directory_of_engine is None or comparison_mode not in MODES:
+        usage()
+        sys.exit(2)
+
+    sys.exit(run_golden_results(file_of_queries, directory_of_engine, comparison_mode, file_of_golden_results,
+                                arguments_of_reference, arguments_of_candidate, tolerance_of_ranks,
+                                tolerance_of_scores))